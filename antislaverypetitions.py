@@ -51,6 +51,7 @@ import re
 import traceback
 import optparse
 import calendar
+import multiprocessing
 
 import tsvfile
 import dataversestudybuilder
@@ -67,8 +68,336 @@ def CustomDateParse(input_string):
     raise e
 
 
+# List of values to ignore in the input data.
+IGNORE_VALUES = ['not available', 'na']
+
+
+def Warn(message, warnings=None):
+  '''Warn
+
+  Prints a warning, or appends it to the list "warnings" if one is given.
+  '''
+  if warnings is None:
+    print message
+  else:
+    warnings.append(message)
+
+
+def _AddOriginalLink(curr, value):
+  value = value.strip()
+  curr.AddDescriptionHtml(
+      '<p>Original: <a href="%s">%s</a> </p>' % (value, value), 2)
+
+
+def _SetPublicationCitation(curr, value):
+  curr.Set('Publication Citation',
+      'D. Carpenter, N. Topich and G. Griffin. ' + value)
+
+
+def _AddActionKeywords(curr, value):
+  actions = set(dataversestudybuilder.ParseList(value))
+  for a in actions: curr.AddKeyword('action', a.lower())
+
+
+def _AddIdentifications(curr, value):
+  identifications = dataversestudybuilder.ParseList(value)
+  clean_identifications = []
+  for ident in identifications:
+    curr_ident = str(ident)
+    prev_ident_len = 0
+    while prev_ident_len != len(curr_ident):
+      prev_ident_len = len(curr_ident)
+      for charpair in ('[]', '()', '""'):
+        if (curr_ident.startswith(charpair[0]) and 
+            curr_ident.endswith(charpair[1])):
+          curr_ident = curr_ident[1:-1]
+    clean_identifications.append(curr_ident)
+  for i in clean_identifications: curr.AddKeyword('signatory-category', i)
+  curr.AddDescriptionHtml(
+      '<p>Identifications of signatories: %s </p>' % 
+      ', '.join(identifications), 18)
+
+
+def _AddPrayerFormat(curr, value):
+  curr.AddKeyword('prayer-format', value)
+  curr.AddDescriptionHtml(
+      '<p>Prayer format was <a href="http://en.wikipedia.org/wiki/Printing">printed</a> vs. <a href="http://en.wikipedia.org/wiki/Manuscript">manuscript</a>: %s </p>'
+      % value, 19)
+
+
+def _AddSignatures(curr, value):
+  signatures = dataversestudybuilder.ParseList(value)
+  if signatures:
+    for s in signatures: curr.AddKeyword('signatory',s)
+    curr.AddDescriptionHtml('<p>Selected signatures:<ol><li>%s</li></ol> </p>' %
+        '</li><li>'.join(signatures), 6)
+
+
+ASSIGN = dataversestudybuilder.ASSIGN
+DESCRIBE = dataversestudybuilder.DESCRIBE
+KEYWORD = dataversestudybuilder.KEYWORD
+CALL = dataversestudybuilder.CALL
+
+ACTION_DATE_COLUMNS = ['dateaction%d' % i for i in xrange(1,7)]
+SENT_COLUMN = 'Legislator, committee, or address that the petition was sent to'
+LEGAL_COLUMN = 'Legal voters or males not identified as being non-legal'
+LOCATION_COLUMN = ('Location of the petition at the Massachusetts Archives of '+
+    'the Commonwealth')
+
+# How input columns map to the Study, see dataversestudybuilder.ColumnMapping.
+# The order of the entries is the order of the keywords in the output, so the
+# columns given with --extra_keyword_column are inserted at EXTRA_COLUMN_INDEX.
+COLUMN_MAPPING = [
+  ('PDS link', ASSIGN, 'Publication URL'),
+  ('PDS link', ASSIGN, 'Data Access Place'),
+  ('PDS link', CALL, _AddOriginalLink),
+  ('Scholarly citation', CALL, _SetPublicationCitation),
+  ('Date of creation', ASSIGN, 'Time Period Covered Start'),
+  ('Date of creation', ASSIGN, 'Production Date'),
+  ('Date of creation', DESCRIBE, 'Date of creation', 3, '(unknown)'),
+  ('Date received by legislature and legislative action', DESCRIBE,
+    'Legislative action', 8),
+  ('Legislative action summary', DESCRIBE, 'Legislative action summary', 10),
+  ('Legislative action summary', CALL, _AddActionKeywords),
+  ('Location', ASSIGN, 'Geographic Coverage'),
+  ('Location', DESCRIBE, 'Petition location', 4),
+  (SENT_COLUMN, KEYWORD, 'sent'),
+  (SENT_COLUMN, DESCRIBE, SENT_COLUMN, 5),
+  ('Subject', DESCRIBE, 'Petition subject', 1),
+  ('Total signatures', KEYWORD, 'signatures-total'),
+  (LEGAL_COLUMN, KEYWORD, 'signatures-legal-voters'),
+  ('Females', KEYWORD, 'signatures-females'),
+  ('Female only', KEYWORD, 'signatures-female-only'),
+  ('Female only', DESCRIBE, 'Female only signatures', 17),
+  ('Females of color', KEYWORD, 'signatures-females-of-color'),
+  ('Other males', KEYWORD, 'signatures-other-males'),
+  ('Males of color', KEYWORD, 'signatures-males-of-color'),
+  ('Unidentified', KEYWORD, 'signatures-unidentified'),
+  ('Total signatures', DESCRIBE, 'Total signatures', 9),
+  (LEGAL_COLUMN, DESCRIBE,
+    'Legal voter signatures (males not identified as non-legal)', 11),
+  ('Females', DESCRIBE, 'Female signatures', 12),
+  ('Females of color', DESCRIBE, 'Females of color signatures', 13),
+  ('Males of color', DESCRIBE, 'Males of color signatures', 14),
+  ('Other males', DESCRIBE, 'Other male signatures', 15),
+  ('Unidentified', DESCRIBE, 'Unidentified signatures', 16),
+  (LOCATION_COLUMN, DESCRIBE, LOCATION_COLUMN, 123),
+  ('Identifications', CALL, _AddIdentifications),
+  ('Prayer format', CALL, _AddPrayerFormat),
+  ('At least 3 signatures from the petition', CALL, _AddSignatures),
+  ("Archivist's notes", DESCRIBE, 'Additional archivist notes', 122),
+]
+EXTRA_COLUMN_INDEX = [x[0] for x in COLUMN_MAPPING].index(LOCATION_COLUMN)
+
+_column_mappings = {}
+
+
+def GetColumnMapping(extra_keyword_column=[]):
+  '''GetColumnMapping
+
+  Returns the compiled COLUMN_MAPPING with the extra keyword columns added.
+
+  Compiled mappings are kept for reuse by later rows.
+
+  Params:
+    extra_keyword_column: Optional list of columns to add as keywords.
+
+  Returns:
+    A dataversestudybuilder.ColumnMapping object.
+  '''
+  key = tuple(extra_keyword_column or [])
+  mapping = _column_mappings.get(key)
+  if mapping is None:
+    extra = []
+    for i,f in enumerate(key):
+      extra.append((f, KEYWORD, '-'.join(x.lower() for x in f.split())))
+      extra.append((f, DESCRIBE, f, 50+i))
+    mapping = dataversestudybuilder.ColumnMapping(
+        COLUMN_MAPPING[:EXTRA_COLUMN_INDEX] + extra +
+        COLUMN_MAPPING[EXTRA_COLUMN_INDEX:], read_columns=ACTION_DATE_COLUMNS)
+    _column_mappings[key] = mapping
+  return mapping
+
+
+def ParseAntislaveryPetition(row, author, contact_email=None,
+    extra_keyword_column=[], warnings=None):
+  '''ParseAntislaveryPetition
+
+  Parses a single dict read from a tsv file and creates a Study object.
+
+  Date columns of the row are normalized in place.
+
+  Params:
+    row: The dict from the tsv file to parse.
+    contact_email: An optional email address for contact information.
+    warnings: Optional list to collect warnings in instead of printing them.
+
+  Returns:
+    A finalized DataverseStudyBuilder object containing the parsed data.
+  '''
+  # Setup
+  curr = dataversestudybuilder.DataverseStudyBuilder(IGNORE_VALUES)
+  # Parse dates
+  date_fields = ['Date of creation']+ACTION_DATE_COLUMNS
+  for date_field in date_fields:
+    if curr.Has(row, date_field):
+      try:
+        row[date_field] = CustomDateParse(row[date_field])
+      except ValueError, e:
+        Warn(
+            'WARNING: Failed to parse date "%s", will treat as string:\n%s'
+            % (row[date_field], traceback.format_exc(e)), warnings)
+
+  # Fields
+  if contact_email:
+    curr.Set('Dataverse Contact', contact_email)
+  curr.Set('Dataverse Subject', 'Social Sciences')
+  curr.Set('Author', author)
+  curr.Set('Distributor', 'Massachusetts Archives. Boston, Mass.')
+  curr.Set('Size of Collection', 'Single petition scanned as one or more 11x17 images.')
+  curr.Set('Country/Nation', 'United States')
+  curr.Set('Original Archive', 'Massachusetts Archives, Boston, MA')
+  curr.Set('Availability Status', 'Public')
+  curr.AddDescriptionHtml('<p>Acknowledgements: Supported by the National Endowment for the Humanities (PW-5105612), Massachusetts Archives of the Commonwealth, Radcliffe Institute for Advanced Study at Harvard University, Center for American Political Studies at Harvard University, Institutional Development Initiative at Harvard University, and Harvard University Library.</p>', 99)
+  values = GetColumnMapping(extra_keyword_column).Apply(curr, row)
+  action_dates = []
+  for field in ACTION_DATE_COLUMNS:
+    if field in values:
+      curr.used_input_columns.add(field)
+      try:
+        action_dates.append(CustomDateParse(row[field]))
+      except ValueError, e:
+        Warn(
+            'WARNING: Failed to parse date "%s", will treat as string:\n%s'
+            % (row[field], traceback.format_exc(e)), warnings)
+  if action_dates:
+    curr.AddDescriptionHtml('<p>Actions taken on dates: %s </p>' % (
+      ','.join(action_dates)), 7)
+  if 'Date of creation' in values:
+    action_dates.append(row['Date of creation'])
+  if action_dates:
+    max_date = max(action_dates)
+    min_date = min(action_dates)
+    if len(min_date) < 7:
+      min_date += '-01'
+    if len(min_date) < 10 and '-' in min_date:
+      min_date += '-01'
+    if len(max_date) < 7:
+      max_date += '-12'
+    if len(max_date) < 10 and '-' in min_date:
+      max_date += ('-'+str(
+        calendar.monthrange(int(max_date[:4]), int(max_date[5:7]))[-1]))
+    curr.Set('Time Period Covered End', max_date)
+    curr.Set('Time Period Covered Start', min_date)
+  if ('Geographic Coverage' in curr.output and
+      curr.output['Geographic Coverage']):
+    cover = curr.output['Geographic Coverage']
+    if cover == 'Massachusetts':
+      curr.Set('Geographic Unit', 'State')
+    else:
+      curr.Set('Geographic Unit', 'City/Town')
+  title_parts = []
+  if 'Scholarly citation' in values:
+    citation = row['Scholarly citation']
+    result = re.match(r'Digital Archive of Massachusetts Anti-Slavery and Anti-Segregation Petitions(.*) Massachusetts Archives. Boston, Mass.',
+        citation)
+    if result:
+      reference = result.groups(1)[0].strip(' ;.,')
+      title_parts.append(reference)
+  if 'At least 3 signatures from the petition' in values:
+    signatures = dataversestudybuilder.ParseList(
+        row['At least 3 signatures from the petition'])
+    if signatures:
+      title_parts.append('Petition of '+signatures[0])
+  if title_parts:
+    curr.Set('Title', ', '.join(title_parts))
+  else:
+    curr.Set('Title', '(untitled)')
+  separation_bool = dataversestudybuilder.ParseBoolean(row, 
+      'Are the signature columns separated?')
+  if separation_bool is not None:
+    curr.used_input_columns.add('Are the signature columns separated?')
+    value = 'column separated' if separation_bool else 'not column separated'
+    curr.AddKeyword('signatory-column-format', value)
+    curr.AddDescriptionHtml('<p>Signatory column format: %s </p>' % value, 20)
+  docs_bool = dataversestudybuilder.ParseBoolean(row, 
+      'Does the archives have additional non-petition or unrelated documents?')
+  if docs_bool is not None:
+    curr.used_input_columns.add(
+        'Does the archives have additional non-petition or unrelated documents?'
+        )
+    value = ('additional documents available' if docs_bool else
+        'no additional documents')
+    curr.AddDescriptionHtml(
+        '<p>Additional non-petition or unrelated documents available at archive: %s </p>' %
+        value, 121)
+
+  # Set a local ID
+  id_fields = ['PDS link', 'Subject', 'Location',
+      'At least 3 signatures from the petition']
+  id_parts = [row.get(x, '').replace(' ', '')[:50] for x in id_fields]
+  curr.Set('Local ID', '|'.join(id_parts))
+
+  # Finalize
+  curr.Finalize()
+  return curr
+
+
+def _ParseAntislaveryPetitionWorker(args):
+  # Runs in a multiprocessing.Pool worker. Warnings are sent back with the
+  # result so the parent can print them in input order.
+  warnings = []
+  study = ParseAntislaveryPetition(*args, warnings=warnings)
+  return study, warnings
+
+
+def IterAntislaveryPetitions(input_rows, author, contact_email=None,
+    extra_keyword_column=[], processes=1, chunksize=64):
+  '''IterAntislaveryPetitions
+
+  Parses an iterable of dicts read from a tsv file, yielding Study objects.
+
+  Each row is parsed only when the next Study is requested, so rows can be
+  streamed from tsvfile.IterDicts and written out one at a time.
+
+  With processes > 1 the rows are parsed in a pool of worker processes. The
+  Studies and the warnings for each row still come out in input order, so the
+  output is the same as a serial run. The input rows are not modified in this
+  case, since they are parsed in copies sent to the workers. Only a few
+  chunks of rows are read ahead of the Study being yielded, see
+  dataversestudybuilder.BoundedImap.
+
+  Params:
+    input_rows: The iterable of dicts from the tsv file to parse.
+    contact_email: An optional email address for contact information.
+    processes: Optional number of worker processes, default 1 (serial).
+    chunksize: Optional number of rows sent to a worker at a time.
+
+  Returns:
+    A generator of DataverseStudyBuilder objects in input order.
+  '''
+  if processes <= 1:
+    for row in input_rows:
+      yield ParseAntislaveryPetition(row, author, contact_email,
+          extra_keyword_column)
+    return
+  pool = multiprocessing.Pool(processes)
+  try:
+    tasks = ((row, author, contact_email, extra_keyword_column)
+        for row in input_rows)
+    for study, warnings in dataversestudybuilder.BoundedImap(pool,
+        _ParseAntislaveryPetitionWorker, tasks, chunksize, 2*processes):
+      for message in warnings:
+        print message
+      yield study
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
 def ParseAntislaveryPetitions(input_rows, author, contact_email=None, 
-    extra_keyword_column=[]):
+    extra_keyword_column=[], processes=1):
   '''ParseAntislaveryPetitions
 
   Parses a list of dicts read from a tsv file and creates Study objects.
@@ -79,227 +408,52 @@ def ParseAntislaveryPetitions(input_rows, author, contact_email=None,
   Params:
     input_rows: The list of dicts from the tsv file to parse.
     contact_email: An optional email address for contact information.
+    processes: Optional number of worker processes, default 1 (serial).
 
   Returns:
     A list of DataverseStudyBuilder objects containing the parsed data.
   '''
-  # List of values to ignore in the input data.
-  ignore_values = ['not available', 'na']
+  return list(IterAntislaveryPetitions(input_rows, author, contact_email,
+      extra_keyword_column, processes))
 
-  # Iterate over all inputs and collect output objects.
-  output_studies = []
-  for row in input_rows:
-    # Setup
-    curr = dataversestudybuilder.DataverseStudyBuilder(ignore_values)
-    # Parse dates
-    date_fields = ['Date of creation']+['dateaction%d' % i for i in xrange(1,7)]
-    for date_field in date_fields:
-      if curr.Has(row, date_field):
-        try:
-          row[date_field] = CustomDateParse(row[date_field])
-        except ValueError, e:
-          print (
-              'WARNING: Failed to parse date "%s", will treat as string:\n%s'
-              % (row[date_field], traceback.format_exc(e)))
-
-    # Fields
-    if contact_email:
-      curr.Set('Dataverse Contact', contact_email)
-    curr.Set('Dataverse Subject', 'Social Sciences')
-    curr.Set('Author', author)
-    curr.Set('Distributor', 'Massachusetts Archives. Boston, Mass.')
-    curr.Set('Size of Collection', 'Single petition scanned as one or more 11x17 images.')
-    curr.Set('Country/Nation', 'United States')
-    curr.Set('Original Archive', 'Massachusetts Archives, Boston, MA')
-    curr.Set('Availability Status', 'Public')
-    curr.SingleAssign(row, 'PDS link', 'Publication URL')
-    curr.SingleAssign(row, 'PDS link', 'Data Access Place')
-    curr.AddDescriptionHtml('<p>Acknowledgements: Supported by the National Endowment for the Humanities (PW-5105612), Massachusetts Archives of the Commonwealth, Radcliffe Institute for Advanced Study at Harvard University, Center for American Political Studies at Harvard University, Institutional Development Initiative at Harvard University, and Harvard University Library.</p>', 99)
-    if curr.Has(row, 'PDS link'):
-      curr.used_input_columns.add('PDS link')
-      value = row['PDS link'].strip()
-      curr.AddDescriptionHtml(
-          '<p>Original: <a href="%s">%s</a> </p>' % (
-            value, value),
-          2)
-    if curr.Has(row, 'Scholarly citation'):
-      curr.Set('Publication Citation',
-          'D. Carpenter, N. Topich and G. Griffin. ' + 
-          row['Scholarly citation'])
-    curr.SingleAssign(row, 'Date of creation', 'Time Period Covered Start')
-    curr.SingleAssign(row, 'Date of creation', 'Production Date')
-    curr.AddDescriptionEntry(row, 'Date of creation', 'Date of creation', 3,
-        '(unknown)')
-    curr.AddDescriptionEntry(row,
-        'Date received by legislature and legislative action',
-        'Legislative action', 8)
-    curr.AddDescriptionEntry(row, 'Legislative action summary',
-        'Legislative action summary', 10)
-    if curr.Has(row, 'Legislative action summary'):
-      curr.used_input_columns.add('Legislative action summary')
-      actions = set(dataversestudybuilder.ParseList(
-        row['Legislative action summary']))
-      for a in actions: curr.AddKeyword('action', a.lower())
-    action_dates = []
-    for field in ['dateaction%d' % i for i in range(1,7)]:
-      if curr.Has(row, field):
-        curr.used_input_columns.add(field)
-        try:
-          action_dates.append(CustomDateParse(row[field]))
-        except ValueError, e:
-          print (
-              'WARNING: Failed to parse date "%s", will treat as string:\n%s'
-              % (row[field], traceback.format_exc(e)))
-    if action_dates:
-      curr.AddDescriptionHtml('<p>Actions taken on dates: %s </p>' % (
-        ','.join(action_dates)), 7)
-    if curr.Has(row, 'Date of creation'):
-      action_dates.append(row['Date of creation'])
-    if action_dates:
-      max_date = max(action_dates)
-      min_date = min(action_dates)
-      if len(min_date) < 7:
-        min_date += '-01'
-      if len(min_date) < 10 and '-' in min_date:
-        min_date += '-01'
-      if len(max_date) < 7:
-        max_date += '-12'
-      if len(max_date) < 10 and '-' in min_date:
-        max_date += ('-'+str(
-          calendar.monthrange(int(max_date[:4]), int(max_date[5:7]))[-1]))
-      curr.Set('Time Period Covered End', max_date)
-      curr.Set('Time Period Covered Start', min_date)
-    curr.SingleAssign(row, 'Location', 'Geographic Coverage')
-    if ('Geographic Coverage' in curr.output and
-        curr.output['Geographic Coverage']):
-      cover = curr.output['Geographic Coverage']
-      if cover == 'Massachusetts':
-        curr.Set('Geographic Unit', 'State')
-      else:
-        curr.Set('Geographic Unit', 'City/Town')
-    curr.AddDescriptionEntry(row, 'Location', 'Petition location', 4)
-    curr.AddKeywordEntry(row,
-        'Legislator, committee, or address that the petition was sent to',
-        'sent')
-    curr.AddDescriptionEntry(row,
-        'Legislator, committee, or address that the petition was sent to',
-        'Legislator, committee, or address that the petition was sent to', 5)
-    curr.AddDescriptionEntry(row, 'Subject', 'Petition subject', 1)
-    curr.AddKeywordEntry(row, 'Total signatures', 'signatures-total')
-    curr.AddKeywordEntry(row,
-        'Legal voters or males not identified as being non-legal',
-        'signatures-legal-voters')
-    curr.AddKeywordEntry(row, 'Females', 'signatures-females')
-    curr.AddKeywordEntry(row, 'Female only', 'signatures-female-only')
-    curr.AddDescriptionEntry(row, 'Female only', 'Female only signatures', 17)
-    curr.AddKeywordEntry(row, 'Females of color', 'signatures-females-of-color')
-    curr.AddKeywordEntry(row, 'Other males', 'signatures-other-males')
-    curr.AddKeywordEntry(row, 'Males of color', 'signatures-males-of-color')
-    curr.AddKeywordEntry(row, 'Unidentified', 'signatures-unidentified')
-    curr.AddDescriptionEntry(row, 'Total signatures', 'Total signatures', 9)
-    curr.AddDescriptionEntry(row,
-        'Legal voters or males not identified as being non-legal',
-        'Legal voter signatures (males not identified as non-legal)', 11)
-    curr.AddDescriptionEntry(row, 'Females', 'Female signatures', 12)
-    curr.AddDescriptionEntry(row, 'Females of color', 'Females of color signatures',
-        13)
-    curr.AddDescriptionEntry(row, 'Males of color', 'Males of color signatures',
-        14)
-    curr.AddDescriptionEntry(row, 'Other males', 'Other male signatures', 15)
-    curr.AddDescriptionEntry(row, 'Unidentified', 'Unidentified signatures', 16)
-    if extra_keyword_column:
-      for i,f in enumerate(extra_keyword_column):
-        curr.AddKeywordEntry(row, f, '-'.join(x.lower() for x in f.split()))
-        extra_idx = i-1-len(extra_keyword_column)
-        extra_idx = 50+i
-        curr.AddDescriptionEntry(row, f, f, extra_idx)
-    loc = ('Location of the petition at the Massachusetts Archives of the '+
-        'Commonwealth')
-    curr.AddDescriptionEntry(row, loc, loc, 123)
-    if curr.Has(row, 'Identifications'):
-      curr.used_input_columns.add('Identifications')
-      identifications = dataversestudybuilder.ParseList(row['Identifications'])
-      clean_identifications = []
-      for ident in identifications:
-        curr_ident = str(ident)
-        prev_ident_len = 0
-        while prev_ident_len != len(curr_ident):
-          prev_ident_len = len(curr_ident)
-          for charpair in ('[]', '()', '""'):
-            if (curr_ident.startswith(charpair[0]) and 
-                curr_ident.endswith(charpair[1])):
-              curr_ident = curr_ident[1:-1]
-        clean_identifications.append(curr_ident)
-      for i in clean_identifications: curr.AddKeyword('signatory-category', i)
-      curr.AddDescriptionHtml(
-          '<p>Identifications of signatories: %s </p>' % 
-          ', '.join(identifications), 18)
-    if curr.Has(row, 'Prayer format'):
-      curr.used_input_columns.add('Prayer format')
-      value = row['Prayer format']
-      curr.AddKeyword('prayer-format', value)
-      curr.AddDescriptionHtml(
-          '<p>Prayer format was <a href="http://en.wikipedia.org/wiki/Printing">printed</a> vs. <a href="http://en.wikipedia.org/wiki/Manuscript">manuscript</a>: %s </p>'
-          % value, 19)
-    if curr.Has(row, 'At least 3 signatures from the petition'):
-      curr.used_input_columns.add('At least 3 signatures from the petition')
-      signatures = dataversestudybuilder.ParseList(
-          row['At least 3 signatures from the petition'])
-      if signatures:
-        for s in signatures: curr.AddKeyword('signatory',s)
-        curr.AddDescriptionHtml('<p>Selected signatures:<ol><li>%s</li></ol> </p>' %
-            '</li><li>'.join(signatures), 6)
-    title_parts = []
-    if curr.Has(row, 'Scholarly citation'):
-      curr.used_input_columns.add('Scholarly citation')
-      citation = row['Scholarly citation']
-      result = re.match(r'Digital Archive of Massachusetts Anti-Slavery and Anti-Segregation Petitions(.*) Massachusetts Archives. Boston, Mass.',
-          citation)
-      if result:
-        reference = result.groups(1)[0].strip(' ;.,')
-        title_parts.append(reference)
-    if curr.Has(row, 'At least 3 signatures from the petition'):
-      curr.used_input_columns.add('At least 3 signatures from the petition')
-      signatures = dataversestudybuilder.ParseList(
-          row['At least 3 signatures from the petition'])
-      if signatures:
-        title_parts.append('Petition of '+signatures[0])
-    if title_parts:
-      curr.Set('Title', ', '.join(title_parts))
-    else:
-      curr.Set('Title', '(untitled)')
-    curr.AddDescriptionEntry(row, "Archivist's notes", 
-        'Additional archivist notes', 122)
-    separation_bool = dataversestudybuilder.ParseBoolean(row, 
-        'Are the signature columns separated?')
-    if separation_bool is not None:
-      curr.used_input_columns.add('Are the signature columns separated?')
-      value = 'column separated' if separation_bool else 'not column separated'
-      curr.AddKeyword('signatory-column-format', value)
-      curr.AddDescriptionHtml('<p>Signatory column format: %s </p>' % value, 20)
-    docs_bool = dataversestudybuilder.ParseBoolean(row, 
-        'Does the archives have additional non-petition or unrelated documents?')
-    if docs_bool is not None:
-      curr.used_input_columns.add(
-          'Does the archives have additional non-petition or unrelated documents?'
-          )
-      value = ('additional documents available' if docs_bool else
-          'no additional documents')
-      curr.AddDescriptionHtml(
-          '<p>Additional non-petition or unrelated documents available at archive: %s </p>' %
-          value, 121)
-
-    # Set a local ID
-    id_fields = ['PDS link', 'Subject', 'Location',
-        'At least 3 signatures from the petition']
-    id_parts = [row.get(x, '').replace(' ', '')[:50] for x in id_fields]
-    curr.Set('Local ID', '|'.join(id_parts))
-
-    # Finalize
-    curr.Finalize()
-    output_studies.append(curr)
-
-  return output_studies
+
+class ColumnCoverageCounter(object):
+  '''ColumnCoverageCounter
+
+  Accumulates the used and unused input columns as rows are parsed.
+
+  Only the column names are kept, so it can follow a stream of any length.
+  '''
+
+  def __init__(self):
+    self.all_input_cols = set()
+    self.all_used_cols = set()
+
+  def AddInputRow(self, input_row):
+    self.all_input_cols.update(input_row.iterkeys())
+
+  def AddStudy(self, study):
+    self.all_used_cols.update(study.used_input_columns)
+
+  def Report(self, verbose=True):
+    '''Report
+
+    Params:
+      verbose: Optional boolean, set True to print results to stdout.
+
+    Returns:
+      Tuple of (used, unused) with sets of used and unused columns.
+    '''
+    bad_reports = self.all_used_cols - self.all_input_cols
+    if bad_reports:
+      raise RuntimeError('BUG bad column reports: %s' % ', '.join(
+          sorted(list(bad_reports))))
+    unused_cols = self.all_input_cols-self.all_used_cols
+    if verbose:
+      print 'Used columns: %d/%d' % (len(self.all_used_cols),
+          len(self.all_input_cols))
+      print 'Unused: %s' % ', '.join(sorted(list(unused_cols)))
+    return (set(self.all_used_cols), unused_cols)
 
 
 def ColumnCoverage(input_rows, output_studies, verbose=True):
@@ -307,6 +461,8 @@ def ColumnCoverage(input_rows, output_studies, verbose=True):
 
   Counts the used and unused input columns for a set of generated studies.
 
+  See also: ColumnCoverageCounter
+
   Params:
     input_rows: List of dicts of input data.
     output_studies: List of DataverseStudyBuilder objects parsed from the input.
@@ -315,19 +471,12 @@ def ColumnCoverage(input_rows, output_studies, verbose=True):
   Returns:
     Tuple of (used, unused) with counts of used and unused columns.
   '''
-  all_input_cols = set(itertools.chain(*
-    [x.keys() for x in input_rows]))
-  all_used_cols = set(itertools.chain(*
-    [x.used_input_columns for x in output_studies]))
-  bad_reports = all_used_cols - all_input_cols
-  if bad_reports:
-    raise RuntimeError('BUG bad column reports: %s' % ', '.join(
-        sorted(list(bad_reports))))
-  unused_cols = all_input_cols-all_used_cols
-  if verbose:
-    print 'Used columns: %d/%d' % (len(all_used_cols), len(all_input_cols))
-    print 'Unused: %s' % ', '.join(sorted(list(unused_cols)))
-  return (all_used_cols, unused_cols)
+  coverage = ColumnCoverageCounter()
+  for row in input_rows:
+    coverage.AddInputRow(row)
+  for study in output_studies:
+    coverage.AddStudy(study)
+  return coverage.Report(verbose)
 
 
 def RunMain(input_tsv,
@@ -339,6 +488,12 @@ def RunMain(input_tsv,
     output_ddi_data_file=None,
     contact_email=None,
     extra_keyword_column=[],
+    streaming=False,
+    processes=1,
+    ddi_workers=1,
+    output_ddi_zip_only=False,
+    output_ddi_data_file_link='copy',
+    output_ddi_incremental=False,
     ):
   '''RunMain
 
@@ -358,17 +513,39 @@ def RunMain(input_tsv,
     output_ddi_zip_file: Optional file path to create archive of output_ddi_dir.
     output_ddi_data_file: Optional path of data file to include with Studies.
     contact_email: Optional email address for contact information.
+    streaming: Optional boolean, set True to parse and write one row at a time.
+    processes: Optional number of processes to parse with, default 1.
+    ddi_workers: Optional number of processes writing DDI folders, default 1.
+    output_ddi_zip_only: Optional boolean, set True to write the zip archive
+      directly without writing the folders in output_ddi_dir.
+    output_ddi_data_file_link: Optional way to place output_ddi_data_file in
+      each folder: copy (default), reflink, hardlink, symlink or auto.
+    output_ddi_incremental: Optional boolean, set True to update the output of
+      an earlier run in output_ddi_dir, writing only the changed studies.
   '''
   # Check usage.
   if not output_ddi_dir and output_ddi_zip_file:
     raise ValueError('Must specify output_ddi_dir to use output_ddi_zip_file')
   if not output_ddi_dir and output_ddi_data_file:
     raise ValueError('Must specify output_ddi_dir to use output_ddi_data_file')
+  if output_ddi_zip_only and not output_ddi_zip_file:
+    raise ValueError(
+        'Must specify output_ddi_zip_file to use output_ddi_zip_only')
+  if output_ddi_incremental and output_ddi_zip_only:
+    raise ValueError(
+        'Cannot use output_ddi_incremental with output_ddi_zip_only')
+
+  if streaming:
+    RunMainStreaming(input_tsv, author, print_column_coverage, output_tsv,
+        output_ddi_dir, output_ddi_zip_file, output_ddi_data_file,
+        contact_email, extra_keyword_column, processes, ddi_workers,
+        output_ddi_zip_only, output_ddi_data_file_link, output_ddi_incremental)
+    return
 
   # Read the input data and parse it to create Study objects.
   input_rows = tsvfile.ReadDicts(input_tsv)
   output_studies = ParseAntislaveryPetitions(input_rows, author, contact_email,
-      extra_keyword_column)
+      extra_keyword_column, processes)
   output_rows = [x.OutputAsDict() for x in output_studies]
   print '=========================='
   print 'Processed %d input rows into %d output studies.' % (
@@ -379,7 +556,7 @@ def RunMain(input_tsv,
 
   # If flagged, print the column coverage of the studies.
   if print_column_coverage:
-    PrintColumnCoverage(input_rows, output_studies)
+    ColumnCoverage(input_rows, output_studies)
 
   # If we are writing an intermediate file, output the studies as dicts.
   if output_tsv:
@@ -396,7 +573,84 @@ def RunMain(input_tsv,
         data_filepath=output_ddi_data_file,
         output_zip_file=output_ddi_zip_file,
         pretty=True,
-        verbose=True)
+        verbose=True,
+        workers=ddi_workers,
+        zip_only=output_ddi_zip_only,
+        data_file_link=output_ddi_data_file_link,
+        incremental=output_ddi_incremental)
+
+
+def RunMainStreaming(input_tsv, author, print_column_coverage=False,
+    output_tsv=None, output_ddi_dir=None, output_ddi_zip_file=None,
+    output_ddi_data_file=None, contact_email=None, extra_keyword_column=[],
+    processes=1, ddi_workers=1, output_ddi_zip_only=False,
+    output_ddi_data_file_link='copy', output_ddi_incremental=False):
+  '''RunMainStreaming
+
+  Runs the same routine as RunMain while holding only one row at a time.
+
+  Rows are read, parsed, finalized and written one by one. The column coverage
+  and output keys are accumulated along the way. The tsv output is spooled
+  through a temp file because its header is only known at the end. The input
+  is read twice: once to count the rows for the DDI folder layout, once to
+  parse it.
+
+  Params:
+    See RunMain.
+  '''
+  num_rows = 0
+  for unused_row in tsvfile.IterDicts(input_tsv):
+    num_rows += 1
+  coverage = ColumnCoverageCounter()
+  output_keys = set()
+  counters = {'studies':0}
+  tsv_writer = (tsvfile.SpooledDictWriter(output_tsv) if output_tsv
+      else None)
+
+  def ObservedRows():
+    for row in tsvfile.IterDicts(input_tsv):
+      coverage.AddInputRow(row)
+      yield row
+
+  def ObservedStudies():
+    for study in IterAntislaveryPetitions(ObservedRows(), author,
+        contact_email, extra_keyword_column, processes):
+      coverage.AddStudy(study)
+      counters['studies'] += 1
+      output_row = study.OutputAsDict()
+      output_keys.update(output_row.iterkeys())
+      if tsv_writer is not None:
+        tsv_writer.Write(output_row)
+      yield study
+
+  if output_ddi_dir:
+    print '=========================='
+    print 'Creating DDI files:'
+    dataversestudybuilder.WriteStudiesToXmlFolders(
+        ObservedStudies(),
+        output_ddi_dir,
+        data_filepath=output_ddi_data_file,
+        output_zip_file=output_ddi_zip_file,
+        pretty=True,
+        verbose=True,
+        num_studies=num_rows,
+        workers=ddi_workers,
+        zip_only=output_ddi_zip_only,
+        data_file_link=output_ddi_data_file_link,
+        incremental=output_ddi_incremental)
+  else:
+    for unused_study in ObservedStudies():
+      pass
+
+  print '=========================='
+  print 'Processed %d input rows into %d output studies.' % (
+      num_rows, counters['studies'])
+  print 'All output keys:'
+  print ', '.join(sorted(list(output_keys)))
+  if print_column_coverage:
+    coverage.Report()
+  if tsv_writer is not None:
+    tsv_writer.Close()
 
 
 def TestAntislaveryPetitions():
@@ -472,6 +726,23 @@ if __name__ == '__main__':
       help='Contact email address.')
   parser.add_option('--author', 
       help='Author for the Dataverse.')
+  parser.add_option('--streaming', nargs=0, default=False,
+      help='Parse and write one row at a time to keep memory use constant.')
+  parser.add_option('--processes', type='int', default=1,
+      help='Number of processes to parse input rows with, default 1.')
+  parser.add_option('--output_ddi_data_file_link', default='copy',
+      choices=sorted(dataversestudybuilder.DATA_FILE_LINK_MODES),
+      help='How to place --output_ddi_data_file in each folder: copy '
+      '(default), or reflink, hardlink or symlink falling back to copy, or '
+      'auto to try reflink then hardlink.')
+  parser.add_option('--output_ddi_zip_only', nargs=0, default=False,
+      help='Write --output_ddi_zip_file directly, without the folders in '
+      '--output_ddi_dir, which only names the top folder in the archive.')
+  parser.add_option('--output_ddi_incremental', nargs=0, default=False,
+      help='Update the output of an earlier run in --output_ddi_dir, only '
+      'writing studies that changed and deleting those that are gone.')
+  parser.add_option('--ddi_workers', type='int', default=1,
+      help='Number of processes writing DDI folders, default 1.')
   parser.add_option('--extra_keyword_column',
       help='Specify an extra column to use for keywords, can be repeated.',
       action='append')
@@ -489,7 +760,8 @@ if __name__ == '__main__':
     print ''
     sys.exit(0)
   # Set boolean values for boolean option flags.
-  for key in ['test', 'print_column_coverage']:
+  for key in ['test', 'print_column_coverage', 'streaming',
+      'output_ddi_zip_only', 'output_ddi_incremental']:
     if key in options and options[key] is (): options[key] = True
   # If the user specified test, run a test and then exit.
   if options['test']:
@@ -508,10 +780,19 @@ if __name__ == '__main__':
         'Must specify --output_ddi_dir to use --output_ddi_data_file.')
   if not options['output_ddi_dir'] and not options['output_tsv']:
     print 'WARNING: No outputs specified. Use --output_ddi_dir, output_ddi_zip_file, and/or --output_tsv to write parsed output.'
-  if options['output_ddi_dir'] and os.path.exists(options['output_ddi_dir']):
+  if options['output_ddi_zip_only'] and not options['output_ddi_zip_file']:
+    raise ValueError(
+        'Must specify --output_ddi_zip_file to use --output_ddi_zip_only.')
+  if options['output_ddi_incremental'] and options['output_ddi_zip_only']:
+    raise ValueError(
+        'Cannot use --output_ddi_incremental with --output_ddi_zip_only.')
+  if (options['output_ddi_dir'] and not options['output_ddi_zip_only'] and
+      not options['output_ddi_incremental'] and
+      os.path.exists(options['output_ddi_dir'])):
     raise ValueError(
         "Output directory specified by --output_ddi_dir already exists. Delete it by running `rm -r '%s'` or choose a different output directory." % options['output_ddi_dir'])
   if (options['output_ddi_zip_file'] and
+      not options['output_ddi_incremental'] and
       os.path.exists(options['output_ddi_zip_file'])):
     raise ValueError(
         "Output file specified by --output_ddi_zip_file already exists. Delete it by running `rm '%s'` or choose a different output filename." % options['output_ddi_zip_file'])
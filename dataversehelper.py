@@ -25,41 +25,55 @@ Date: February 23 2018
 import sys
 import requests
 import urllib
-import os
 import json
-import httplib2
+import threading
 from xml import etree
 import zipfile
 import io
 from StringIO import StringIO
 
+import timeout
+import jsonjournal
+
 
 class DataverseHelper(object):
   dataverse_server = 'dataverse.harvard.edu'  # Production.
 
   def __init__(self, api_key, dataverse_object_or_name='', 
-      entity_id_cache_file=None, server=None):
+      entity_id_cache_file=None, server=None, pool_connections=4,
+      pool_maxsize=10, compact_cache_on_load=True, mapping_store=None):
+    # pool_connections is the number of hosts to keep connection pools for,
+    # pool_maxsize is the number of keep-alive connections kept per host.
+    # Every request made by this class goes through the pooled session.
+    # Objects of the dataverse library, e.g. from _get_current_dataverse or
+    # dataversewrapper, make their own requests without it.
+    # mapping_store is an optional mappingstore.MappingStore that is checked
+    # on a cache miss and receives every entity ID that is cached.
     self.api_key = api_key
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
     self.dataverse_server = (server if server else
         DataverseHelper.dataverse_server)
     self.api_base_url = 'https://%s/api' % self.dataverse_server
     self.query_base_url = '%s/search?key=%s&show_entity_ids=true&q=' % (
         self.api_base_url, api_key)
     self.entity_id_cache_file = entity_id_cache_file
+    # Guards entity_id_cache and its file when used from several threads.
+    self.entity_id_cache_lock = threading.RLock()
     if entity_id_cache_file is not None:
-      if os.path.isfile(entity_id_cache_file):
-        with open(entity_id_cache_file) as fid:
-          cache_string = fid.read()
-          self.entity_id_cache = json.loads(cache_string)
-          print 'Loaded %d cache entries from file: %s' % (
-              len(self.entity_id_cache), entity_id_cache_file)
-      else:
-        print >>sys.stderr, 'Initializing empty cache from file: %s' % (
-            entity_id_cache_file)
-        self.entity_id_cache = {}
+      # New entries go to an append-only journal next to the JSON file, which
+      # is compacted back into the JSON file on load.
+      self.entity_id_journal = jsonjournal.JsonJournal(entity_id_cache_file,
+          compact_on_load=compact_cache_on_load)
+      self.entity_id_cache = self.entity_id_journal.data
     else:
       print >>sys.stderr, 'Initializing memory-only cache.'
+      self.entity_id_journal = None
       self.entity_id_cache = {}
+    self.mapping_store = mapping_store
     self.dataverse_connection = None
     if isinstance(dataverse_object_or_name, basestring):
       self.dataverse_object = None
@@ -67,10 +81,11 @@ class DataverseHelper(object):
     else:
       self.dataverse_object = dataverse_object_or_name
 
-  @staticmethod
-  def _httpget(url, asjson=True):
-    resp, content = httplib2.Http().request(url)
-    if not resp['status'] == '200':
+  def _httpget(self, url, asjson=True):
+    # Bound the request by the deadline of the calling task, if any.
+    resp = self.session.get(url, timeout=timeout.remaining())
+    content = resp.content
+    if not resp.status_code == 200:
       print content
       raise RuntimeError('URL request failed: %s' % url)
     if asjson:
@@ -114,21 +129,103 @@ class DataverseHelper(object):
       return None
     return data['entity_id']
 
+  def _cache_entity_ids(self, entity_ids):
+    with self.entity_id_cache_lock:
+      if self.entity_id_journal is not None:
+        self.entity_id_journal.update(entity_ids)
+      else:
+        self.entity_id_cache.update(entity_ids)
+
   def set_entity_id(self, doi, entity_id):
-    self.entity_id_cache[doi] = entity_id
-    if self.entity_id_cache_file is not None:
-      with open(self.entity_id_cache_file, 'w') as fid:
-        fid.write(json.dumps(self.entity_id_cache, indent=2))
-      print >>sys.stderr, 'Wrote %d entries to cache file: %s' % (
-          len(self.entity_id_cache), self.entity_id_cache_file)
+    self.set_entity_ids({doi:entity_id})
+
+  def set_entity_ids(self, entity_ids):
+    # Batch version of set_entity_id, taking a dict of DOI -> entity ID.
+    self._cache_entity_ids(entity_ids)
+    if self.mapping_store is not None:
+      self.mapping_store.set_entity_ids(entity_ids)
+
+  def compact_entity_id_cache(self):
+    if self.entity_id_journal is not None:
+      self.entity_id_journal.compact()
 
   def get_entity_id(self, doi):
-    if not doi in self.entity_id_cache:
-      entity_id = self._get_entity_id(doi)
-      if entity_id is not None:
-        self.set_entity_id(doi, entity_id)
+    with self.entity_id_cache_lock:
+      if doi in self.entity_id_cache:
+        return self.entity_id_cache[doi]
+    entity_id = None
+    if self.mapping_store is not None:
+      entity_id = self.mapping_store.get_entity_id(doi)
+    if entity_id is not None:
+      self._cache_entity_ids({doi:entity_id})
       return entity_id
-    return self.entity_id_cache[doi]
+    # Query outside the lock so other threads are not blocked on the network.
+    entity_id = self._get_entity_id(doi)
+    if entity_id is not None:
+      self.set_entity_id(doi, entity_id)
+    return entity_id
+
+  def _get_dataverse_alias(self):
+    if self.dataverse_object is not None:
+      return self.dataverse_object.alias
+    return self.dataverse_name
+
+  def iter_datasets(self, per_page=1000, sort='date', order='asc'):
+    # Pages through the search API for all datasets in the target dataverse,
+    # yielding one search result item per dataset. Dataverse caps per_page at
+    # 1000. Results are sorted oldest first by default, so datasets created
+    # while paging land on the last page instead of shifting the pages not
+    # yet read, which would skip or repeat items.
+    alias = self._get_dataverse_alias()
+    if not alias:
+      # Without a subtree the search covers every dataset on the server.
+      raise ValueError('A dataverse name is needed to list its datasets.')
+    start = 0
+    while True:
+      params = [
+          ('q', '*'),
+          ('type', 'dataset'),
+          ('start', start),
+          ('per_page', per_page),
+          ('show_entity_ids', 'true'),
+          ('sort', sort),
+          ('order', order),
+          ('subtree', alias),
+          ('key', self.api_key),
+          ]
+      url = '%s/search?%s' % (self.api_base_url, urllib.urlencode(params))
+      print 'Run dataset search from %d: %s' % (start, url)
+      data = self._httpget(url)
+      if not data.get('status') == 'OK':
+        raise RuntimeError('Search failed bad status "%s": %s' % (
+          data.get('status'), url))
+      result_container = data.get('data')
+      if not result_container:
+        raise RuntimeError('Search failed with no data: %s' % url)
+      results = result_container.get('items')
+      if results is None:
+        raise RuntimeError('Search failed with no items: %s' % url)
+      for result in results:
+        yield result
+      start += len(results)
+      if not results or start >= result_container.get('total_count', 0):
+        break
+
+  def prefetch_entity_ids(self, per_page=1000):
+    # Fills the entity ID cache for every dataset in the dataverse with a few
+    # paged searches, instead of one search per DOI in get_entity_id.
+    entity_ids = {}
+    for result in self.iter_datasets(per_page):
+      doi = result.get('global_id')
+      entity_id = result.get('entity_id')
+      if not doi or entity_id is None:
+        continue
+      if self.entity_id_cache.get(doi) != entity_id:
+        entity_ids[doi] = entity_id
+    self.set_entity_ids(entity_ids)
+    print 'Prefetched %d new entity IDs, %d total in cache.' % (
+        len(entity_ids), len(self.entity_id_cache))
+    return len(entity_ids)
 
   def get_study_metadata(self, doi, version='latest'):
     # Set version=None to retrieve a list containing the data for ALL versions.
@@ -166,11 +263,12 @@ class DataverseHelper(object):
         self.api_base_url,
         entity_id
         )
-    resp = requests.put(
+    resp = self.session.put(
         url,
         headers={'Content-Type': 'application/json'},
         data=json.dumps(metadata),
         params={'key': self.api_key},
+        timeout=timeout.remaining(),
         )
     if resp.status_code != 200:
       raise RuntimeError('Failed: %s %s' % (str(resp), resp.content))
@@ -269,15 +367,16 @@ class DataverseHelper(object):
         'Content-Disposition': 'filename=temp.zip'
         }
     auth = self._get_current_dataverse().connection.auth
-    r = requests.post(self.get_edit_media_uri(doi), data=data, headers=headers,
-        auth=auth)
+    r = self.session.post(self.get_edit_media_uri(doi), data=data,
+        headers=headers, auth=auth, timeout=timeout.remaining())
     r.raise_for_status()
 
   def publish_study(self, doi):
-    r = requests.post(
+    r = self.session.post(
         self.get_edit_uri(doi),
         headers={'In-Progress': 'false', 'Content-Length': '0'},
         auth=(self.api_key, None),
+        timeout=timeout.remaining(),
         )
     r.raise_for_status()
 
@@ -299,12 +398,13 @@ class DataverseHelper(object):
     #url = dv.collection.get('href').replace('beta.harvard.edu', 'beta.dataverse.org')
     url = dv.collection.get('href')
     print 'resp = requests.post(%r,\n  data="<entry xmlns=...>...</entry>",\n  headers={"Content-type": "application/atom+xml"},\n  auth=(my_api_key, None))' % (url)
-    resp = requests.post(
+    resp = self.session.post(
         #dv.collection.get('href'),
         url,
         data=dataset.get_entry(),
         headers={'Content-type': 'application/atom+xml'},
         auth=dv.connection.auth,
+        timeout=timeout.remaining(),
         )
     if resp.status_code != 201:
       raise RuntimeError('Failed to add newly created dataset to Dataverse.')
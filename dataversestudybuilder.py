@@ -44,15 +44,27 @@ Quantitative Social Science (IQSS) [2].
 [2] http://www.iq.harvard.edu/contact-us
 '''
 
+import sys
 import re
 import shutil
 import os
 import math
 import traceback
+import multiprocessing
+import time
+import zipfile
+import zlib
+import errno
+import collections
+import itertools
+import hashlib
+import json
+import glob
 from datetime import datetime
 
 import xmlformatter
 import jsonformatter
+import tsvfile
 
 
 def HasNonblank(input_dict, key):
@@ -109,56 +121,71 @@ def ParseList(input_string, delimiter=','):
   return [x.strip() for x in input_string.split(delimiter)]
 
 
-def ParseDate(input_date):
-  '''ParseDate
+# Patterns for ParseDate, compiled once at import.
+_FULL_MATCHER = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2})$')
+_YEAR_MATCHER = re.compile(r'^(\d{4})$')
+_YEAR_MONTH_MATCHER = re.compile(r'^(\d{4})-?(\d{2})$')
+_TRAIL_4_MATCHER = re.compile(r'^(\d{4})-?00-?00$')
+_TRAIL_2_MATCHER = re.compile(r'^(\d{4})-?(\d{2})-?00$')
+_ISO_PREFIX_MATCHER = re.compile(r'\d{4}-\d{2}-\d{2}')
 
-  Converts an input date in a variety of formats into an ISO date string.
+# Maximum number of distinct raw strings remembered by ParseDate.
+PARSE_DATE_CACHE_SIZE = 4096
+_parse_date_cache = collections.OrderedDict()
 
-  Valid input formats include:
-    YYYYMMDD as string
-    YYYY as string
-    YYYYMMDD as int
-    YYYY as int
-    YYYYMMDD as string in E notation (e.g. 1.8500101E7)
 
-  Raises an error if no valid parsing was found.
-  Replaces trailing zeros with 1: YYYY-MM-00 becomes YYYY-MM-01.
+def _DateError(input_date):
+  return ValueError('Failed to parse input date: "%s"\n%s' % (
+    input_date, traceback.format_exc()))
 
-  Params:
-    input_date: The input date string to parse.
 
-  Returns:
-    The date in full or substring of ISO format YYYY-MM-DD.
-  '''
+def _ParseDigitDate(input_date):
+  # Fast path for the common YYYY and YYYYMMDD forms: slice the digits and
+  # check the date with the datetime constructor instead of regexes/strptime.
+  if len(input_date) == 4:
+    return input_date
+  year, month, day = input_date[:4], input_date[4:6], input_date[6:]
+  try:
+    if month == '00' and day == '00':
+      datetime(int(year), 1, 1)
+      return year
+    if day == '00':
+      datetime(int(year), int(month), 1)
+      return '%s-%s' % (year, month)
+    datetime(int(year), int(month), int(day))
+  except ValueError:
+    raise _DateError(input_date)
+  return '%s-%s-%s' % (year, month, day)
+
+
+def _ParseDateUncached(input_date):
   if ',' in input_date:
     return min([ParseDate(x.strip()) for x in input_date.split(',')])
   canonical = None
   input_date = input_date.strip()
-  full_matcher = re.compile(r'^(\d{4})-?(\d{2})-?(\d{2})$')
-  year_matcher = re.compile(r'^(\d{4})$')
-  year_month_matcher = re.compile(r'^(\d{4})-?(\d{2})$')
-  trail_4_matcher = re.compile(r'^(\d{4})-?00-?00$')
-  trail_2_matcher = re.compile(r'^(\d{4})-?(\d{2})-?00$')
-  if year_matcher.match(input_date):
+  if (type(input_date) is str and len(input_date) in (4, 8) and
+      input_date.isdigit()):
+    return _ParseDigitDate(input_date)
+  if _YEAR_MATCHER.match(input_date):
     return input_date
-  elif trail_4_matcher.match(input_date):
+  elif _TRAIL_4_MATCHER.match(input_date):
     # Then we have four trailing zeros.
-    canonical = re.sub(trail_4_matcher, r'\1', input_date)
-  elif trail_2_matcher.match(input_date):
+    canonical = _TRAIL_4_MATCHER.sub(r'\1', input_date)
+  elif _TRAIL_2_MATCHER.match(input_date):
     # Then we have two trailing zeros.
-    canonical = re.sub(trail_2_matcher, r'\1-\2', input_date)
-  elif re.match(r'\d{4}-\d{2}-\d{2}', input_date):
+    canonical = _TRAIL_2_MATCHER.sub(r'\1-\2', input_date)
+  elif _ISO_PREFIX_MATCHER.match(input_date):
     canonical = input_date
-  elif full_matcher.match(input_date):
-    canonical = re.sub(full_matcher, r'\1-\2-\3', input_date)
-  elif year_month_matcher.match(input_date):
-    canonical = re.sub(year_month_matcher, r'\1-\2', input_date)
+  elif _FULL_MATCHER.match(input_date):
+    canonical = _FULL_MATCHER.sub(r'\1-\2-\3', input_date)
+  elif _YEAR_MONTH_MATCHER.match(input_date):
+    canonical = _YEAR_MONTH_MATCHER.sub(r'\1-\2', input_date)
   else:
     # Then assume it's in scientific notation 1.8190527E7
     use_date = str(int(float(input_date)))
-    if not full_matcher.match(use_date):
+    if not _FULL_MATCHER.match(use_date):
       raise ValueError('Failed to parse input date: "%s"' % input_date)
-    canonical = re.sub(full_matcher, r'\1-\2-\3', use_date)
+    canonical = _FULL_MATCHER.sub(r'\1-\2-\3', use_date)
   # Verify that the canonical date string is legal.
   try:
     if len(canonical) == 10:
@@ -171,11 +198,49 @@ def ParseDate(input_date):
       raise ValueError('Expected substring of YYYY-MM-DD, got length %d' % 
           len(canonical))
   except ValueError, e:
-    raise ValueError('Failed to parse input date: "%s"\n%s' % (
-      input_date, traceback.format_exc(e)))
+    raise _DateError(input_date)
   return canonical
 
 
+def ParseDate(input_date):
+  '''ParseDate
+
+  Converts an input date in a variety of formats into an ISO date string.
+
+  Valid input formats include:
+    YYYYMMDD as string
+    YYYY as string
+    YYYYMMDD as int
+    YYYY as int
+    YYYYMMDD as string in E notation (e.g. 1.8500101E7)
+
+  Raises an error if no valid parsing was found.
+  Replaces trailing zeros with 1: YYYY-MM-00 becomes YYYY-MM-01.
+
+  Results are kept in a least-recently-used cache of PARSE_DATE_CACHE_SIZE
+  raw input strings, since the same dates repeat across many rows.
+
+  Params:
+    input_date: The input date string to parse.
+
+  Returns:
+    The date in full or substring of ISO format YYYY-MM-DD.
+  '''
+  try:
+    canonical = _parse_date_cache.pop(input_date)
+  except KeyError:
+    canonical = _ParseDateUncached(input_date)
+    if len(_parse_date_cache) >= PARSE_DATE_CACHE_SIZE:
+      _parse_date_cache.popitem(last=False)
+  _parse_date_cache[input_date] = canonical
+  return canonical
+
+
+def _Intern(name):
+  # Field names repeat in every Study, so keep one copy of each.
+  return intern(name) if type(name) is str else name
+
+
 class DataverseStudyBuilder(object):
   '''DataverseStudyBuilder
 
@@ -188,7 +253,18 @@ class DataverseStudyBuilder(object):
 
   These objects can be used with WriteStudiesToXmlFolders to create a zip
   archive of Studies suitable for batch import by the Harvard IQSS team.
+
+  Many thousands of these objects may be held at once, so they are kept
+  compact: there is no per-instance __dict__, the normalized ignore_values are
+  shared between all instances built with the same list, field names are
+  interned, and the description parts and keywords are stored as flat lists of
+  alternating values instead of lists of tuples.
   '''
+  __slots__ = ('description_parts', 'keywords', 'used_input_columns',
+      'output', 'ignore_values', 'dirty')
+
+  # Shared normalized ignore_values, keyed by the tuple passed in.
+  _ignore_values_cache = {}
 
   def __init__(self, ignore_values=[]):
     '''__init__
@@ -198,13 +274,34 @@ class DataverseStudyBuilder(object):
     Params:
       ignore_values: A list of strings to consider as null if passed as inputs.
     '''
-    self.description_parts = []
-    self.keywords = []
+    self.description_parts = []  # [order, html_data, order, html_data, ...]
+    self.keywords = []  # [keyword, value, keyword, value, ...]
     self.used_input_columns = set()
     self.output = {}
-    self.ignore_values = [x.lower().strip() for x in ignore_values]
+    self.ignore_values = DataverseStudyBuilder._SharedIgnoreValues(
+        ignore_values)
     self.dirty = False
 
+  @staticmethod
+  def _SharedIgnoreValues(ignore_values):
+    key = tuple(ignore_values)
+    shared = DataverseStudyBuilder._ignore_values_cache.get(key)
+    if shared is None:
+      shared = frozenset([x.lower().strip() for x in ignore_values])
+      DataverseStudyBuilder._ignore_values_cache[key] = shared
+    return shared
+
+  def __getstate__(self):
+    # Needed to pickle a class with __slots__, e.g. for multiprocessing.
+    return (self.description_parts, self.keywords, self.used_input_columns,
+        self.output, tuple(self.ignore_values), self.dirty)
+
+  def __setstate__(self, state):
+    (self.description_parts, self.keywords, self.used_input_columns,
+        self.output, ignore_values, self.dirty) = state
+    self.ignore_values = DataverseStudyBuilder._SharedIgnoreValues(
+        ignore_values)
+
   def Has(self, input_dict, key):
     '''Has
 
@@ -252,7 +349,7 @@ class DataverseStudyBuilder(object):
       output_field: The field in the Study to assign the value.
       output_value: The value to assign to the field.
     '''
-    self.output[output_field] = output_value
+    self.output[_Intern(output_field)] = output_value
 
   def SingleAssign(self, input_dict, input_key, output_field):
     '''SingleAssign
@@ -270,7 +367,7 @@ class DataverseStudyBuilder(object):
     if self.Has(input_dict, input_key):
       self.used_input_columns.add(input_key)
       value = input_dict[input_key].strip()
-      self.output[output_field] = value
+      self.output[_Intern(output_field)] = value
 
   def AddDescriptionHtml(self, html_data, order):
     '''AddDescriptionHtml
@@ -286,7 +383,7 @@ class DataverseStudyBuilder(object):
       html_data: A string of HTML to insert into the Description.
       order: The order of this portion of the Description compared to the rest.
     '''
-    self.description_parts.append((order, html_data))
+    self.description_parts.extend((order, html_data))
     self.dirty = True
 
   def AddDescriptionEntry(self, input_dict, input_key, label, order,
@@ -349,7 +446,7 @@ class DataverseStudyBuilder(object):
       keyword: The keyword to which the value is assigned.
       value: The value to assign to the keyword.
     '''
-    self.keywords.append((keyword, value.strip()))
+    self.keywords.extend((_Intern(keyword), value.strip()))
     self.dirty = True
 
   def Finalize(self):
@@ -362,12 +459,14 @@ class DataverseStudyBuilder(object):
     requested with OutputAsDict or OutputAsXmlString.
     '''
     if self.dirty:
-      if self.description_parts:
+      parts = self.description_parts
+      if parts:
         self.output['Description'] = ' '.join(
-            [x[1] for x in sorted(self.description_parts)])
-      if self.keywords:
+            [x[1] for x in sorted(zip(parts[0::2], parts[1::2]))])
+      keywords = self.keywords
+      if keywords:
         self.output['Keywords'] = ', '.join(
-            ['%s:"%s"' % (x[0], x[1]) for x in self.keywords])
+            ['%s:"%s"' % x for x in zip(keywords[0::2], keywords[1::2])])
       self.dirty = False
 
   def OutputAsDict(self):
@@ -419,12 +518,354 @@ class DataverseStudyBuilder(object):
       print 'Wrote %d lines of XML to file: "%s"' % (num_lines, output_filepath)
 
 
+# Kinds of step in a column mapping table, see ColumnMapping.
+ASSIGN = 'assign'
+DESCRIBE = 'describe'
+KEYWORD = 'keyword'
+CALL = 'call'
+
+
+class ColumnMapping(object):
+  '''ColumnMapping
+
+  A table mapping input columns to Study fields, compiled for fast reuse.
+
+  Each entry of the table is a tuple starting with the input column and the
+  kind of step, in the same spirit as the DataverseStudyBuilder methods:
+    (column, ASSIGN, output_field)  -- like SingleAssign
+    (column, DESCRIBE, label, order[, value_for_blank])  -- like
+        AddDescriptionEntry
+    (column, KEYWORD, keyword)  -- like AddKeywordEntry
+    (column, CALL, function)  -- calls function(study, raw_value)
+  Steps only run for columns with a valid value, except DESCRIBE steps with a
+  value_for_blank. Steps run in table order, which matters for the order of
+  keywords and when several steps assign the same field.
+
+  Apply checks each distinct column once per row against the ignore_values of
+  the Study, where calling the builder methods would check it once per call.
+  '''
+
+  def __init__(self, table, read_columns=[]):
+    '''__init__
+
+    Params:
+      table: List of step tuples as described above.
+      read_columns: Optional extra columns to normalize and return from Apply
+        for use by code outside the table.
+    '''
+    self.steps = []
+    self.columns = []
+    seen = set()
+    for entry in table:
+      column, kind = entry[:2]
+      if kind == ASSIGN:
+        step = (column, kind, _Intern(entry[2]))
+      elif kind == DESCRIBE:
+        label, order = entry[2:4]
+        blank = entry[4] if len(entry) > 4 else None
+        step = (column, kind, ('<p>%s: ' % label, order, (None if blank is None
+          else '<p>%s: %s </p>' % (label, blank))))
+      elif kind == KEYWORD:
+        step = (column, kind, _Intern(entry[2]))
+      elif kind == CALL:
+        step = (column, kind, entry[2])
+      else:
+        raise ValueError('Unknown column mapping kind: %s' % kind)
+      self.steps.append(step)
+    for column in [x[0] for x in table] + list(read_columns):
+      if column not in seen:
+        seen.add(column)
+        self.columns.append(column)
+
+  def Apply(self, study, input_dict):
+    '''Apply
+
+    Applies the table to one input row.
+
+    Params:
+      study: The DataverseStudyBuilder to fill in.
+      input_dict: The input row.
+
+    Returns:
+      Dict of column to stripped value for the table and read_columns columns
+      that have a valid value, as checked by DataverseStudyBuilder.Has.
+    '''
+    ignore_values = study.ignore_values
+    values = {}
+    for column in self.columns:
+      raw = input_dict.get(column)
+      if raw is None:
+        continue
+      value = raw.strip()
+      if value and value.lower() not in ignore_values:
+        values[column] = value
+    used_input_columns = study.used_input_columns
+    for column, kind, arg in self.steps:
+      value = values.get(column)
+      if value is None:
+        if kind == DESCRIBE and arg[2] is not None:
+          study.AddDescriptionHtml(arg[2], arg[1])
+        continue
+      used_input_columns.add(column)
+      if kind == ASSIGN:
+        study.output[arg] = value
+      elif kind == DESCRIBE:
+        study.AddDescriptionHtml('%s%s </p>' % (arg[0], value), arg[1])
+      elif kind == KEYWORD:
+        study.AddKeyword(arg, value)
+      else:
+        arg(study, input_dict[column])
+    return values
+
+
+# Linux ioctl cloning a whole file, see ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+DATA_FILE_LINK_MODES = {
+    'copy': (),
+    'reflink': ('reflink',),
+    'hardlink': ('hardlink',),
+    'symlink': ('symlink',),
+    'auto': ('reflink', 'hardlink'),
+    }
+
+
+def _Reflink(src, dst):
+  import fcntl  # Unix only.
+  with open(src, 'rb') as src_fid:
+    with open(dst, 'wb') as dst_fid:
+      fcntl.ioctl(dst_fid.fileno(), _FICLONE, src_fid.fileno())
+
+
+def PlaceDataFile(data_filepath, output_dir, link_mode='copy'):
+  '''PlaceDataFile
+
+  Places a data file into a folder by linking it if possible, else copying.
+
+  Params:
+    data_filepath: Path of the data file to place.
+    output_dir: The folder in which to place the file.
+    link_mode: One of the keys of DATA_FILE_LINK_MODES. Modes other than
+      "copy" try the listed kinds of link in order and copy if none works.
+
+  Returns:
+    The number of bytes not written thanks to linking, 0 if copied.
+  '''
+  dest = os.path.join(output_dir, os.path.basename(data_filepath))
+  for kind in DATA_FILE_LINK_MODES[link_mode]:
+    if os.path.lexists(dest):
+      os.remove(dest)
+    try:
+      if kind == 'reflink':
+        _Reflink(data_filepath, dest)
+      elif kind == 'hardlink':
+        os.link(data_filepath, dest)
+      else:
+        os.symlink(os.path.abspath(data_filepath), dest)
+      return os.path.getsize(data_filepath)
+    except (OSError, IOError), e:
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP,
+          errno.ENOTTY, errno.EINVAL, errno.EMLINK, errno.ENOSYS):
+        raise
+  if os.path.lexists(dest):
+    os.remove(dest)
+  shutil.copy(data_filepath, output_dir)
+  return 0
+
+
+def _MapChunk(args):
+  # Runs in a multiprocessing.Pool worker for BoundedImap.
+  func, chunk = args
+  return [func(x) for x in chunk]
+
+
+def BoundedImap(pool, func, items, chunksize=1, max_pending=2):
+  '''BoundedImap
+
+  Maps func over items in a multiprocessing.Pool, yielding results in order.
+
+  Unlike pool.imap, which reads all of items in a background thread as fast as
+  it can, items are read on the calling thread and only max_pending chunks are
+  sent to the pool ahead of the result being yielded. Memory use stays bounded
+  for a streamed input, and any side effects of reading items happen on the
+  calling thread, in step with the results.
+
+  Params:
+    pool: The multiprocessing.Pool to run func in.
+    func: Function of one item, which must be picklable.
+    items: Iterable of items, which must be picklable.
+    chunksize: Optional number of items sent to a worker at a time, default 1.
+    max_pending: Optional number of chunks in the pool at a time, default 2.
+      Twice the number of processes keeps them all busy.
+
+  Returns:
+    A generator of the results of func in the order of items.
+  '''
+  items = iter(items)
+  pending = collections.deque()
+  while True:
+    while len(pending) < max_pending:
+      chunk = list(itertools.islice(items, chunksize))
+      if not chunk:
+        break
+      pending.append(pool.apply_async(_MapChunk, [(func, chunk)]))
+    if not pending:
+      return
+    for result in pending.popleft().get():
+      yield result
+
+
+def _WriteStudyFolder(args):
+  # Writes one study folder. Runs in a multiprocessing.Pool worker when
+  # WriteStudiesToXmlFolders is called with workers > 1. Returns the bytes
+  # saved by linking the data file.
+  study, output_dir, data_filepath, pretty, verbose, data_file_link = args
+  xml_file = os.path.join(output_dir, 'study.xml')
+  study.WriteXmlFile(xml_file, pretty=pretty, verbose=verbose)
+  if data_filepath is not None:
+    return PlaceDataFile(data_filepath, output_dir, data_file_link)
+  return 0
+
+
+def _RenderStudyXml(args):
+  # Renders one study for an archive written without staging folders. Runs in
+  # a multiprocessing.Pool worker when WriteStudiesToXmlFolders is called with
+  # workers > 1.
+  study, output_dir = args[:2]
+  pretty = args[3]
+  return output_dir, study.OutputAsXmlString(pretty)
+
+
+def _ZipArcParts(path):
+  # Splits a path into the parts of a zip member name, dropping the drive,
+  # leading separators and ".." the way `zip -r` does, so an absolute or
+  # relative output_root_dir gives the same member names as zipping it.
+  path = os.path.normpath(os.path.splitdrive(path)[1])
+  return [x for x in path.split(os.sep) if x not in ('', os.curdir, os.pardir)]
+
+
+# The ZipFile internals used by _PrecompressedZipEntry.WriteTo, which mirrors
+# ZipFile.writestr of Python 2.7.
+_PRECOMPRESSED_ZIP_SUPPORTED = (sys.version_info[:2] == (2, 7) and
+    hasattr(zipfile.ZipFile, '_writecheck'))
+
+
+class _PrecompressedZipEntry(object):
+  '''_PrecompressedZipEntry
+
+  A file compressed once and then stored in a zip archive under many names.
+
+  The zip format needs a separate copy of the data for every entry, but the
+  deflate step does not have to be repeated. ZipFile has no public API for
+  writing compressed data, so WriteTo follows ZipFile.writestr of Python 2.7.
+  On other versions it falls back to ZipFile.write, compressing every copy.
+  '''
+
+  def __init__(self, filepath):
+    self.filepath = filepath
+    if not _PRECOMPRESSED_ZIP_SUPPORTED:
+      return
+    with open(filepath, 'rb') as fid:
+      data = fid.read()
+    st = os.stat(filepath)
+    self.date_time = time.localtime(st.st_mtime)[:6]
+    self.external_attr = (st.st_mode & 0xFFFF) << 16L
+    self.file_size = len(data)
+    self.crc = zlib.crc32(data) & 0xffffffff
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+        -15)
+    self.compressed = compressor.compress(data) + compressor.flush()
+
+  def WriteTo(self, zip_file, arcname):
+    if not _PRECOMPRESSED_ZIP_SUPPORTED:
+      zip_file.write(self.filepath, arcname, zipfile.ZIP_DEFLATED)
+      return
+    zinfo = zipfile.ZipInfo(arcname, self.date_time)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = self.external_attr
+    zinfo.file_size = self.file_size
+    zinfo.compress_size = len(self.compressed)
+    zinfo.CRC = self.crc
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+    zip64 = (zinfo.file_size > zipfile.ZIP64_LIMIT or
+        zinfo.compress_size > zipfile.ZIP64_LIMIT)
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    zip_file.fp.write(self.compressed)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+
+
+def ManifestPath(output_root_dir):
+  '''ManifestPath
+
+  Returns the path of the incremental build manifest for an output folder.
+
+  The manifest sits next to the folder rather than in it, so it is not zipped
+  up with the studies.
+
+  Params:
+    output_root_dir: The root directory passed to WriteStudiesToXmlFolders.
+  '''
+  return os.path.normpath(output_root_dir) + '.manifest.json'
+
+
+def _DataFileSignature(data_filepath, data_file_link):
+  # Changing the data file or how it is placed rewrites every study folder.
+  if data_filepath is None:
+    return None
+  st = os.stat(data_filepath)
+  return [os.path.basename(data_filepath), st.st_size, int(st.st_mtime),
+      data_file_link]
+
+
+def _StudyHash(row, pretty, data_signature):
+  return hashlib.sha1(json.dumps([row, pretty, data_signature],
+    sort_keys=True)).hexdigest()
+
+
+def _ReadManifest(manifest_file):
+  if not os.path.isfile(manifest_file):
+    return {}
+  with open(manifest_file) as fid:
+    return json.loads(fid.read())['studies']
+
+
+def _WriteManifest(manifest_file, studies):
+  temp_path = tsvfile.MakeTempPath(manifest_file)
+  with open(temp_path, 'wb') as fid:
+    fid.write(json.dumps({'version':1, 'studies':studies}, indent=2,
+      sort_keys=True))
+    fid.flush()
+    os.fsync(fid.fileno())
+  os.rename(temp_path, manifest_file)
+
+
+def _RemoveStaleStudyFolders(output_root_dir, keep_dirs):
+  # Deletes study folders not in keep_dirs, then any emptied split folders.
+  # Only paths shaped like the ones WriteStudiesToXmlFolders creates are
+  # touched.
+  keep_dirs = set(os.path.normpath(x) for x in keep_dirs)
+  removed = 0
+  pattern = os.path.join(output_root_dir, 'dir_studies_*', 'study_*')
+  for study_dir in glob.glob(pattern):
+    if os.path.normpath(study_dir) not in keep_dirs:
+      shutil.rmtree(study_dir)
+      removed += 1
+  for split_dir in glob.glob(os.path.join(output_root_dir, 'dir_studies_*')):
+    if not os.listdir(split_dir):
+      os.rmdir(split_dir)
+  return removed
+
+
 def WriteStudiesToXmlFolders(study_builder_objects, output_root_dir,
     data_filepath=None, output_zip_file=None, pretty=True, verbose=True,
-    max_study_per_folder=200):
+    max_study_per_folder=200, num_studies=None, workers=1, zip_only=False,
+    data_file_link='copy', incremental=False):
   '''WriteStudiesToXmlFolders
 
-  Writes a list of DataverseStudyBuilder objects to folders as XML.
+  Writes a list or iterator of DataverseStudyBuilder objects to folders as XML.
 
   Each DataverseStudyBuilder will be output as an XML file in a separate folder
   with optional included data files. These folders will be themselves grouped
@@ -447,6 +888,18 @@ def WriteStudiesToXmlFolders(study_builder_objects, output_root_dir,
 
   NOTE: This has only been tested in Linux, as it relies on a call to os.system!
 
+  With zip_only, nothing is written under output_root_dir. The study.xml
+  entries are streamed straight into output_zip_file as they are rendered,
+  using the same paths as zipping the folders would. The data file is
+  compressed once and the result is stored for every study.
+
+  With incremental, output_root_dir may hold the output of an earlier run. A
+  manifest next to it (see ManifestPath) records a hash of every study by its
+  Local ID. Only studies whose hash changed are written again, unchanged
+  studies whose folder name changed are renamed, and folders of studies that
+  are gone are deleted. The hash covers the study dict, the pretty flag and
+  the size and time of the data file.
+
   Params:
     study_builder_objects: List of DataverseStudyBuilder objects to write out.
     output_root_dir: The root directory to contain subfolders for the Studies.
@@ -455,26 +908,139 @@ def WriteStudiesToXmlFolders(study_builder_objects, output_root_dir,
     pretty: Optional boolean to pretty-print the XML, default True.
     verbose: Optional boolean to print logging information, default True.
     max_study_per_folder: Maximum studies per output folder, default 200.
+    num_studies: Number of studies, required if study_builder_objects is an
+      iterator rather than a list so studies can be written as they arrive.
+    workers: Optional number of processes rendering and writing the studies,
+      default 1. Folder names are assigned in input order before the studies
+      are handed out, so the layout is the same for any number of workers.
+    zip_only: Optional boolean, write output_zip_file without the folders.
+    data_file_link: Optional way to place data_filepath in each folder, see
+      PlaceDataFile. Default "copy".
+    incremental: Optional boolean, update the output of an earlier run.
   '''
-  ctr = 0
-  num_folder_splits = math.ceil(
-      len(study_builder_objects)/float(max_study_per_folder))
-  for study in study_builder_objects:
-    ctr += 1
-    row = study.OutputAsDict()
-    if verbose: print 'Row to XML %d/%d' % (ctr, len(study_builder_objects))
-    split_counter = math.ceil(ctr/float(max_study_per_folder))
-    subfolder_split = 'dir_studies_%03dof%03d' % (split_counter, num_folder_splits)
-    subfolder_study = 'study_%s' % xmlformatter.FormatToXml.SafeFilename(row)
-    output_dir = os.path.join(output_root_dir, subfolder_split, subfolder_study)
-    if not os.path.isdir(output_dir): os.makedirs(output_dir)
-    xml_file = os.path.join(output_dir, 'study.xml')
-    study.WriteXmlFile(xml_file, pretty=pretty, verbose=verbose)
-    if data_filepath is not None:
-      shutil.copy(data_filepath, output_dir)
-  if output_zip_file is None:
+  if zip_only and output_zip_file is None:
+    raise ValueError('Must specify output_zip_file to use zip_only')
+  if zip_only and incremental:
+    raise ValueError('Cannot use incremental with zip_only')
+  if data_file_link not in DATA_FILE_LINK_MODES:
+    raise ValueError('Unknown data_file_link "%s", expected one of: %s' % (
+      data_file_link, ', '.join(sorted(DATA_FILE_LINK_MODES))))
+  if num_studies is None:
+    num_studies = len(study_builder_objects)
+  num_folder_splits = math.ceil(num_studies/float(max_study_per_folder))
+  counter = {'ctr':0}
+  if incremental:
+    manifest_file = ManifestPath(output_root_dir)
+    old_manifest = _ReadManifest(manifest_file)
+    new_manifest = {}
+    data_signature = _DataFileSignature(data_filepath, data_file_link)
+    stats = {'written':0, 'moved':0, 'unchanged':0}
+  def FolderTasks():
+    for study in study_builder_objects:
+      counter['ctr'] += 1
+      ctr = counter['ctr']
+      row = study.OutputAsDict()
+      if verbose: print 'Row to XML %d/%d' % (ctr, num_studies)
+      split_counter = math.ceil(ctr/float(max_study_per_folder))
+      subfolder_split = 'dir_studies_%03dof%03d' % (split_counter,
+          num_folder_splits)
+      subfolder_study = 'study_%s' % xmlformatter.FormatToXml.SafeFilename(row)
+      output_dir = os.path.join(output_root_dir, subfolder_split,
+          subfolder_study)
+      if incremental:
+        key = unique_key = row.get('Local ID') or subfolder_study
+        n = 1
+        while unique_key in new_manifest:
+          n += 1
+          unique_key = '%s#%d' % (key, n)
+        study_hash = _StudyHash(row, pretty, data_signature)
+        new_manifest[unique_key] = {'hash':study_hash,
+            'dir':os.path.relpath(output_dir, output_root_dir)}
+        old = old_manifest.get(unique_key)
+        if old is not None and old['hash'] == study_hash:
+          old_dir = os.path.join(output_root_dir, old['dir'])
+          if (os.path.normpath(old_dir) == os.path.normpath(output_dir) and
+              os.path.isdir(output_dir)):
+            stats['unchanged'] += 1
+            continue
+          if os.path.isdir(old_dir) and not os.path.exists(output_dir):
+            os.renames(old_dir, output_dir)
+            stats['moved'] += 1
+            continue
+        stats['written'] += 1
+        # Start from an empty folder so no files of the old version remain.
+        if os.path.isdir(output_dir): shutil.rmtree(output_dir)
+      # Created here so parallel workers never race on the parent folders.
+      if not zip_only and not os.path.isdir(output_dir): os.makedirs(output_dir)
+      # Worker output would interleave, so only the row counter is printed.
+      yield (study, output_dir, data_filepath, pretty,
+          verbose and workers <= 1, data_file_link)
+  write_func = _RenderStudyXml if zip_only else _WriteStudyFolder
+  if zip_only:
+    zip_file = zipfile.ZipFile(output_zip_file, 'w', zipfile.ZIP_DEFLATED,
+        allowZip64=True)
+    data_entry = (_PrecompressedZipEntry(data_filepath) if data_filepath
+        else None)
+    zip_dirs = set()
+    # Like `zip -r`, folder entries start at output_root_dir itself.
+    root_depth = max(1, len(_ZipArcParts(output_root_dir)))
+  bytes_saved = 0
+  pool = multiprocessing.Pool(workers) if workers > 1 else None
+  try:
+    if pool is None:
+      results = (write_func(x) for x in FolderTasks())
+    else:
+      results = BoundedImap(pool, write_func, FolderTasks(), 16, 2*workers)
+    for result in results:
+      if not zip_only:
+        bytes_saved += result
+        continue
+      output_dir, xml_string = result
+      # Add folder entries the way `zip -r` does.
+      parts = _ZipArcParts(output_dir)
+      for i in xrange(root_depth, len(parts)+1):
+        zip_dir = '/'.join(parts[:i]) + '/'
+        if zip_dir not in zip_dirs:
+          zip_dirs.add(zip_dir)
+          zinfo = zipfile.ZipInfo(zip_dir, time.localtime()[:6])
+          zinfo.external_attr = (040755 << 16L) | 0x10  # MS-DOS dir flag.
+          zip_file.writestr(zinfo, '')
+      zinfo = zipfile.ZipInfo('/'.join(parts+['study.xml']),
+          time.localtime()[:6])
+      zinfo.external_attr = 0644 << 16L
+      zip_file.writestr(zinfo, xml_string, zipfile.ZIP_DEFLATED)
+      if data_entry is not None:
+        data_entry.WriteTo(zip_file,
+            '/'.join(parts+[os.path.basename(data_filepath)]))
+    if pool is not None:
+      pool.close()
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+    if zip_only:
+      zip_file.close()
+  ctr = counter['ctr']
+  if ctr != num_studies:
+    raise ValueError('Expected %d studies, got %d' % (num_studies, ctr))
+  if incremental:
+    removed = _RemoveStaleStudyFolders(output_root_dir,
+        [os.path.join(output_root_dir, x['dir'])
+          for x in new_manifest.itervalues()])
+    _WriteManifest(manifest_file, new_manifest)
+    print ('Incremental update: %d written, %d moved, %d unchanged, '
+        '%d removed.' % (stats['written'], stats['moved'], stats['unchanged'],
+          removed))
+  if data_filepath is not None and data_file_link != 'copy' and not zip_only:
+    print 'Linked data file into study folders, saved %d bytes.' % bytes_saved
+  if zip_only:
+    print '\nSuccess!\n\nCreated archive file: %s' % output_zip_file
+  elif output_zip_file is None:
     print '\nSuccess!\n\nWrote to folder: %s' % output_root_dir
   else:
+    # zip -r would otherwise keep entries of removed studies.
+    if incremental and os.path.exists(output_zip_file):
+      os.remove(output_zip_file)
     cmd = 'zip -r %s %s' % (output_zip_file, output_root_dir)
     if verbose: print cmd
     exitcode = os.system(cmd)
@@ -519,8 +1085,94 @@ def TestDataverseStudyBuilder():
     with open(temp_xml_file) as fid:
       fid.write(output_xml)
   assert(truth_xml == output_xml)
+  # The same study built from a column mapping table.
+  mapped = DataverseStudyBuilder(ignore_values=['n/a'])
+  mapped.Set('Title', 'This is the title.')
+  mapping = ColumnMapping([
+      ('author', ASSIGN, 'Author'),
+      ('unusedgeo', ASSIGN, 'Geographic Coverage'),
+      ('description2', DESCRIBE, 'Describe again', 2),
+      ('description1', DESCRIBE, 'Describe first', 1),
+      ('keyword', KEYWORD, 'mykeyword'),
+      ('keyword', CALL, lambda s, v: s.AddKeyword('myotherkeyword',
+        'drowyekrehtoym')),
+      ])
+  values = mapping.Apply(mapped, test_input)
+  mapped.AddDescriptionHtml('<p>Describe bonus!</p>', 3)
+  assert('unusedgeo' not in values and values['author'] == test_input['author'])
+  assert(mapped.used_input_columns == study.used_input_columns)
+  assert(mapped.OutputAsXmlString() == output_xml)
+  print 'Passed.'
+
+
+def TestParseDate():
+  '''TestParseDate
+
+  Runs a test of ParseDate, printing results to stdout.
+  '''
+  print 'Running test...'
+  cases = [
+      ('1850', '1850'),
+      ('18500101', '1850-01-01'),
+      (' 18500101 ', '1850-01-01'),
+      ('18500000', '1850'),
+      ('18500200', '1850-02'),
+      ('1850-02-00', '1850-02'),
+      ('1850-01-01', '1850-01-01'),
+      ('185001', '1850-01'),
+      ('1.8500101E7', '1850-01-01'),
+      ('1.8491231E+07', '1849-12-31'),
+      ('1849-12-31', '1849-12-31'),
+      ('18491231', '1849-12-31'),
+      ('18500101, 18491231', '1849-12-31'),
+      ]
+  for input_date, truth in cases * 2:
+    assert(ParseDate(input_date) == truth)
+  for input_date in ['18500229', '18501301', '00000000', '1850-13', 'bogus']:
+    for i in xrange(2):
+      try:
+        ParseDate(input_date)
+        assert(False)
+      except ValueError:
+        pass
   print 'Passed.'
 
 
+def BenchmarkParseDate(num_dates=100000, num_distinct=3000):
+  '''BenchmarkParseDate
+
+  Times ParseDate on a synthetic column of dates, printing results to stdout.
+
+  The column repeats num_distinct dates in the formats found in the input
+  spreadsheets. See TestParseDate for the expected results.
+  '''
+  import random
+  import timeit
+  rand = random.Random(0)
+  distinct = []
+  for i in xrange(num_distinct):
+    year, month, day = (rand.randint(1780, 1870), rand.randint(1, 12),
+        rand.randint(1, 28))
+    distinct.append(rand.choice([
+      '%04d%02d%02d' % (year, month, day),
+      '%04d%02d00' % (year, month),
+      '%04d0000' % year,
+      '%04d-%02d-%02d' % (year, month, day),
+      '%.7E' % float('%04d%02d%02d' % (year, month, day)),
+      ]))
+  column = [rand.choice(distinct) for i in xrange(num_dates)]
+  def Run():
+    _parse_date_cache.clear()
+    for x in column:
+      ParseDate(x)
+  elapsed = min(timeit.repeat(Run, number=1, repeat=3))
+  print 'ParseDate on %d dates (%d distinct):' % (num_dates, num_distinct)
+  print '  %.3f s (%.0f dates/s)' % (elapsed, num_dates / elapsed)
+
+
 if __name__ == '__main__':
-  TestDataverseStudyBuilder()
+  if '--benchmark' in sys.argv[1:]:
+    BenchmarkParseDate()
+  else:
+    TestParseDate()
+    TestDataverseStudyBuilder()
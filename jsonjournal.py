@@ -0,0 +1,204 @@
+'''jsonjournal.py -- Dict persisted as a JSON snapshot plus an append-only log.
+
+Copyright 2018 Garth Griffin
+Distributed under the GNU GPL v3. For full terms see the file LICENSE.
+
+This file is part of PetitionsDataverse.
+
+PetitionsDataverse is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version.
+
+PetitionsDataverse is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along with
+PetitionsDataverse.  If not, see <http://www.gnu.org/licenses/>.
+________________________________________________________________________________
+
+Author: Garth Griffin (http://garthgriffin.com)
+
+The snapshot file is a plain JSON object, the same format as the older
+whole-file caches, so those are read directly. New entries are appended to
+a journal file next to it as one JSON [key, value] list per line, which costs
+the same for every insert however large the dict gets. Compacting folds the
+journal into a new snapshot.
+'''
+import os
+import sys
+import json
+import tempfile
+import threading
+
+import tsvfile
+
+
+class JsonJournal(object):
+  '''JsonJournal
+
+  A dict of JSON values backed by a snapshot file and an append-only journal.
+
+  Interrupting a write can at most lose the last journal line, which is
+  dropped on the next load. The snapshot is only ever replaced atomically.
+  '''
+
+  def __init__(self, snapshot_file, journal_file=None, compact_on_load=True):
+    '''__init__
+
+    Loads the snapshot and replays the journal on top of it.
+
+    Params:
+      snapshot_file: Path of the JSON snapshot, need not exist yet.
+      journal_file: Optional journal path, defaults to snapshot_file.journal.
+      compact_on_load: Optional boolean, fold the journal into the snapshot.
+    '''
+    self.snapshot_file = snapshot_file
+    self.journal_file = (journal_file if journal_file is not None else
+        snapshot_file + '.journal')
+    self.lock = threading.RLock()
+    self.data = {}
+    self._journal_fid = None
+    self._load()
+    if compact_on_load and os.path.isfile(self.journal_file):
+      self.compact()
+
+  def _load(self):
+    if os.path.isfile(self.snapshot_file):
+      with open(self.snapshot_file) as fid:
+        self.data = json.loads(fid.read())
+    num_snapshot = len(self.data)
+    num_journal = 0
+    if os.path.isfile(self.journal_file):
+      with open(self.journal_file, 'rb') as fid:
+        journal = fid.read()
+      complete_len = journal.rfind('\n') + 1
+      for line in journal[:complete_len].splitlines():
+        if not line.strip():
+          continue
+        key, value = json.loads(line)
+        self.data[key] = value
+        num_journal += 1
+      if complete_len < len(journal):
+        # A partial line is left over from an interrupted append.
+        print >>sys.stderr, 'Dropping partial journal entry in: %s' % (
+            self.journal_file)
+        with open(self.journal_file, 'r+b') as fid:
+          fid.truncate(complete_len)
+    print 'Loaded %d entries (%d from snapshot, %d from journal): %s' % (
+        len(self.data), num_snapshot, num_journal, self.snapshot_file)
+
+  def _journal(self):
+    if self._journal_fid is None:
+      self._journal_fid = open(self.journal_file, 'ab')
+    return self._journal_fid
+
+  def __contains__(self, key):
+    return key in self.data
+
+  def __getitem__(self, key):
+    return self.data[key]
+
+  def __len__(self):
+    return len(self.data)
+
+  def get(self, key, default=None):
+    return self.data.get(key, default)
+
+  def set(self, key, value):
+    '''set
+
+    Sets a key and appends the entry to the journal.
+
+    Params:
+      key: The key to set.
+      value: The JSON-serializable value to set.
+    '''
+    self.update([(key, value)])
+
+  def update(self, items):
+    '''update
+
+    Sets several keys at once with a single journal write.
+
+    Params:
+      items: A dict or an iterable of (key, value) pairs.
+    '''
+    if isinstance(items, dict):
+      items = items.iteritems()
+    lines = []
+    with self.lock:
+      for key, value in items:
+        self.data[key] = value
+        lines.append(json.dumps([key, value]) + '\n')
+      if lines:
+        fid = self._journal()
+        fid.write(''.join(lines))
+        fid.flush()
+
+  def compact(self):
+    '''compact
+
+    Writes all entries to a new snapshot and empties the journal.
+
+    If interrupted, the old snapshot and the journal stay valid. Replaying a
+    journal over a snapshot that already contains it gives the same result.
+    '''
+    with self.lock:
+      temp_path = tsvfile.MakeTempPath(self.snapshot_file)
+      with open(temp_path, 'wb') as fid:
+        fid.write(json.dumps(self.data, indent=2, sort_keys=True))
+        fid.flush()
+        os.fsync(fid.fileno())
+      os.rename(temp_path, self.snapshot_file)
+      self.close()
+      with open(self.journal_file, 'wb'):
+        pass
+      print >>sys.stderr, 'Compacted %d entries to file: %s' % (
+          len(self.data), self.snapshot_file)
+
+  def close(self):
+    with self.lock:
+      if self._journal_fid is not None:
+        self._journal_fid.close()
+        self._journal_fid = None
+
+
+def Test():
+  import shutil
+  tempdir = tempfile.mkdtemp()
+  try:
+    snapshot = os.path.join(tempdir, 'cache.json')
+    # Older whole-file caches are read as snapshots.
+    with open(snapshot, 'w') as fid:
+      fid.write(json.dumps({'doi:1':1}, indent=2))
+    journal = JsonJournal(snapshot, compact_on_load=False)
+    assert(journal['doi:1'] == 1)
+    journal.set('doi:2', 2)
+    journal.update({'doi:3':3, 'doi:1':10})
+    journal.close()
+    # Simulate a crash in the middle of an append.
+    with open(journal.journal_file, 'ab') as fid:
+      fid.write('["doi:4", ')
+    journal = JsonJournal(snapshot, compact_on_load=False)
+    assert(journal.data == {'doi:1':10, 'doi:2':2, 'doi:3':3})
+    journal.set('doi:4', 4)
+    journal.close()
+    os.chmod(snapshot, 0640)
+    journal = JsonJournal(snapshot)
+    # Compacting keeps the permissions of the snapshot it replaces.
+    assert(os.stat(snapshot).st_mode & 0777 == 0640)
+    assert(os.path.getsize(journal.journal_file) == 0)
+    with open(snapshot) as fid:
+      assert(json.loads(fid.read()) == journal.data)
+    assert(len(journal) == 4 and 'doi:4' in journal)
+    journal.close()
+  finally:
+    shutil.rmtree(tempdir)
+  print 'Tests passed.'
+
+
+if __name__ == '__main__':
+  Test()
@@ -24,159 +24,266 @@ Date: February 23 2018
 '''
 import json
 import difflib
+import hashlib
+
+
+class JPath(object):
+  '''JPath
+
+  A slash-separated path into a JSON document, parsed once for reuse.
+
+  Path parts that look like integers index lists. Get returns None for a
+  missing dict key or a step into a value that is not a container.
+  '''
+
+  def __init__(self, path):
+    self.path = path
+    self.parts = tuple(path.strip('/').split('/'))
+    self.steps = tuple((p, _int_or_none(p)) for p in self.parts)
+    self.parent = (JPath('/'.join(self.parts[:-1])) if len(self.parts) > 1
+        else None)
+
+  def _parent_of(self, root):
+    return root if self.parent is None else self.parent.get(root)
+
+  @staticmethod
+  def _key(elem, part, index):
+    return index if index is not None and type(elem) == list else part
+
+  def get(self, root):
+    elem = root
+    for part, index in self.steps:
+      if index is not None:
+        if type(elem) == list:
+          elem = elem[index]
+        elif type(elem) == dict:
+          elem = elem.get(index)
+        else:
+          return None
+      elif type(elem) == dict:
+        elem = elem.get(part, None)
+      else:
+        return None
+    return elem
+
+  def set(self, root, value):
+    elem = self._parent_of(root)
+    part, index = self.steps[-1]
+    elem[self._key(elem, part, index)] = value
+
+  def delete(self, root):
+    if self.get(root) is None:
+      return
+    elem = self._parent_of(root)
+    part, index = self.steps[-1]
+    del elem[self._key(elem, part, index)]
+
+  def create_dicts(self, root):
+    elem = root
+    for part in self.parts:
+      if not part in elem:
+        elem[part] = {}
+      elem = elem[part]
+
+
+def _int_or_none(part):
+  try:
+    return int(part)
+  except ValueError:
+    return None
+
+
+# Maximum number of compiled paths kept by compile_path.
+JPATH_CACHE_SIZE = 256
+_jpath_cache = {}
+
+
+def compile_path(path):
+  '''compile_path
+
+  Returns the JPath for a path string, reusing recently compiled ones.
+
+  Params:
+    path: The slash-separated path, or a JPath which is returned as is.
+  '''
+  if isinstance(path, JPath):
+    return path
+  compiled = _jpath_cache.get(path)
+  if compiled is None:
+    if len(_jpath_cache) >= JPATH_CACHE_SIZE:
+      _jpath_cache.clear()
+    compiled = _jpath_cache[path] = JPath(path)
+  return compiled
 
 
 def jpath(root, path, setdata=None):
-  path_parts = path.strip('/').split('/')
   if setdata is not None:
-    if len(path_parts) == 1:
-      elem = root
-    else:
-      elem = jpath(root, '/'.join(path_parts[:-1]))
-    elem[path_parts[-1]] = setdata
+    compile_path(path).set(root, setdata)
     return
-  elem = root
-  for p in path_parts:
-    try:
-      p = int(p)
-      if type(elem) == list:
-        elem = elem[p]
-      else:
-        elem = elem.get(p) 
-    except ValueError:
-      if type(elem) == dict:
-        elem = elem.get(p, None)
-      else:
-        #raise ValueError('Invalid path: %s at node: %s' % (path, p))
-        return None
-  return elem
+  return compile_path(path).get(root)
 
 
 def jpath_create_dicts(root, path):
-  path_parts = path.strip('/').split('/')
-  elem = root
-  for p in path_parts:
-    if not p in elem:
-      elem[p] = {}
-    elem = elem[p]
+  compile_path(path).create_dicts(root)
   
 
 def jpath_delete(root, path):
-  if jpath(root, path) is None:
+  compile_path(path).delete(root)
+
+
+def _text(value):
+  # Strings compare as text, the way json.dumps writes them.
+  if type(value) is str:
+    return value.decode('utf8')
+  return value
+
+
+def _kind(value):
+  # Values of different kinds are never equal, even if == says they are, so
+  # True differs from 1 and 1 differs from 1.0 as they do in JSON text.
+  if type(value) in (str, unicode):
+    return unicode
+  if type(value) is long:
+    return int
+  return type(value)
+
+
+def _list_key(value):
+  # Dataverse metadata fields are dicts named by typeName, which lets a
+  # changed field line up with its old version. Other elements are keyed by
+  # their content.
+  if type(value) is dict and 'typeName' in value:
+    return ('typeName', _text(value['typeName']))
+  if type(value) in (dict, list):
+    return ('hash', hashlib.sha1(json.dumps(value, sort_keys=True)).digest())
+  return (_kind(value), _text(value))
+
+
+def _pointer(path):
+  # Formats a tuple of keys as a JSON pointer.
+  parts = [u''] + [unicode(k) if isinstance(k, (int, long)) else _text(k)
+      for k in path]
+  return u'/'.join(x.replace(u'~', u'~0').replace(u'/', u'~1') for x in parts)
+
+
+def _op(op, path, old=None, value=None):
+  result = {'op':op, 'path':_pointer(path)}
+  if op != 'add': result['old'] = old
+  if op != 'remove': result['value'] = value
+  return result
+
+
+def _jsonpatch(a, b, path, patch):
+  if a is b:
     return
-  path_parts = path.strip('/').split('/')
-  if len(path_parts) == 0:
+  type_a = type(a)
+  if type_a is type(b) and type_a not in (dict, list):
+    if a != b:
+      patch.append(_op('replace', path, a, b))
     return
-  if len(path_parts) == 1:
-    parent = root
-  else:
-    parent = jpath(root, '/'.join(path_parts[:-1]))
-  del parent[path_parts[-1]]
+  kind = _kind(a)
+  if kind != _kind(b):
+    patch.append(_op('replace', path, a, b))
+  elif kind is dict:
+    if len(a) == len(b) and all(k in b for k in a):
+      for k in sorted(a):
+        _jsonpatch(a[k], b[k], path+(k,), patch)
+      return
+    b_keys = dict((_text(k), k) for k in b)
+    for k in sorted(a, key=_text):
+      text_k = _text(k)
+      if text_k in b_keys:
+        _jsonpatch(a[k], b[b_keys.pop(text_k)], path+(k,), patch)
+      else:
+        patch.append(_op('remove', path+(k,), a[k]))
+    for text_k in sorted(b_keys):
+      k = b_keys[text_k]
+      patch.append(_op('add', path+(k,), value=b[k]))
+  elif kind is list:
+    if len(a) == len(b):
+      # Usually nothing moved, so compare in place before computing keys.
+      pairwise = []
+      for i in xrange(len(a)):
+        _jsonpatch(a[i], b[i], path+(i,), pairwise)
+      if not pairwise:
+        return
+    a_keys = [_list_key(x) for x in a]
+    b_keys = [_list_key(x) for x in b]
+    if a_keys == b_keys:
+      patch.extend(pairwise)
+      return
+    matcher = difflib.SequenceMatcher(None, a_keys, b_keys, autojunk=False)
+    for tag, a_lo, a_hi, b_lo, b_hi in matcher.get_opcodes():
+      if tag == 'equal' or (tag == 'replace' and a_hi-a_lo == b_hi-b_lo):
+        for i, j in zip(xrange(a_lo, a_hi), xrange(b_lo, b_hi)):
+          if a_keys[i][0] == 'typeName' and a_keys[i] != b_keys[j]:
+            # Different fields, so their contents are not compared.
+            patch.append(_op('remove', path+(i,), a[i]))
+            patch.append(_op('add', path+(j,), value=b[j]))
+          else:
+            _jsonpatch(a[i], b[j], path+(i,), patch)
+        continue
+      for i in xrange(a_lo, a_hi):
+        patch.append(_op('remove', path+(i,), a[i]))
+      for j in xrange(b_lo, b_hi):
+        patch.append(_op('add', path+(j,), value=b[j]))
+  elif _text(a) != _text(b):
+    patch.append(_op('replace', path, a, b))
 
-def jsondiff(a, b, verbose=True):
-  alines = json.dumps(a, sort_keys=True, indent=2).split('\n')
-  blines = json.dumps(b, sort_keys=True, indent=2).split('\n')
-  match = True
-  for x in difflib.context_diff(alines, blines):
-    match = False
-    if verbose:
-      print x
+
+def jsonpatch(a, b):
+  '''jsonpatch
+
+  Computes a structural diff of two JSON documents.
+
+  Values are equal if they serialize to the same JSON, so str and unicode
+  with the same text are equal and True and 1 are not. List elements are
+  aligned with difflib.SequenceMatcher on their typeName or, failing that, a
+  hash of their content, so an inserted field is reported once rather than
+  as a change to every later field.
+
+  Params:
+    a: The old document.
+    b: The new document.
+
+  Returns:
+    A list of operations turning a into b, empty if they are equal. Each is a
+    dict with "op" ("add", "remove" or "replace") and "path", a JSON pointer,
+    plus "old" for the value in a and "value" for the value in b. Paths of
+    removed and replaced values index lists of a, added values lists of b.
+  '''
+  patch = []
+  _jsonpatch(a, b, (), patch)
+  return patch
+
+
+def print_jsonpatch(patch, printlen=None):
+  '''print_jsonpatch
+
+  Prints a patch from jsonpatch in a readable form.
+
+  Params:
+    patch: The list of operations returned by jsonpatch.
+    printlen: Optional number of characters to truncate values to.
+  '''
+  def show(value):
+    return json.dumps(value, sort_keys=True)[:printlen]
+  for op in patch:
+    print '--- %s' % (op['path'] or '/')
+    if op['op'] == 'replace':
+      print '<\t%s' % show(op['old'])
+      print '>\t%s' % show(op['value'])
+    elif op['op'] == 'remove':
+      print '-\t%s' % show(op['old'])
     else:
-      break
-  return match
-
-def jsondiff2(a, b, verbose=True, printlen=44, path=[]):
-  # Should use difflib.SequenceMatcher with hashes of list elements to do
-  # diff of lists.
-  if type(a) in [str, unicode, int, bool]:
-    if type(b) != type(a):
-      if verbose:
-        print '--- %s' % path
-        print '<\ttype was %s: %s' % (type(a), repr(a)[:printlen])
-        print '>\ttype now %s: %s' % (type(b), repr(b)[:printlen])
-      return False
-    if a != b:
-      if verbose:
-        print '--- %s' % path
-        print '<\t%s' % (repr(a)[:printlen])
-        print '>\t%s' % (repr(b)[:printlen])
-      return False
-  elif type(a) == list:
-    if type(b) != list:
-      if verbose:
-        print '--- %s' % path
-        print '<\t    list: %s' % (repr(a)[:printlen])
-        print '>\tnon-list: %s' % (repr(b)[:printlen])
-      return False
-    match = True
-    if len(a) != len(b):
-      match = False
-    if verbose:
-      i_a = 0
-      i_b = 0
-      rem_a = []
-      add_b = []
-      while i_a < len(a):
-        if jsondiff(a[i_a], b[i_b], False, printlen, path+[i_a]):
-          i_b += 1
-          i_a += 1
-        else:
-          match = False
-          foundahead = False
-          for j in xrange(10):
-            if i_b+j < len(b):
-              if jsondiff(a[i_a], b[i_b+j], False, 0, []):
-                add_b.extend(range(i_b, i_b+j))
-                i_b = i_b+j
-                foundahead = True
-                break
-            else:
-              break
-          if not foundahead:
-            jsondiff(a[i_a], b[i_b], verbose, printlen, path+[i_a])
-            rem_a.append(i_a)
-          i_a += 1
-      if i_b < len(b):
-        match = False
-        add_b.extend(range(i_b, len(b)))
-      if rem_a or add_b:
-        print '--- %s' % path
-      for i in rem_a:
-        print '-\t[%d]: %s' % (i, repr(a[i])[:printlen])
-      for i in add_b:
-        print '+\t[%d]: %s' % (i, repr(b[i])[:printlen])
-    if not match:
-      return False
-  elif type(a) == dict:
-    if not type(b) == dict:
-      if verbose:
-        print '--- %s' % path
-        print '<\t    dict: %s' % (repr(a)[:printlen])
-        print '>\tnon-dict: %s' % (repr(b)[:printlen])
-      return False
-    match = True
-    extra_b = set(b.keys())
-    printlines = []
-    for k in sorted(a.iterkeys()):
-      if k in b:
-        extra_b.remove(k)
-        if not jsondiff(a[k], b[k], verbose, printlen, path+[k]):
-          match = False
-      else:
-        printlines.append('-\t%s: %s' % (k, repr(a[k])[:printlen]))
-        match = False
-    for k in extra_b:
-      printlines.append('+\t%s: %s' % (k, repr(b[k])[:printlen]))
-      match = False
-    if verbose and printlines:
-      print '--- %s' % path
-      for line in printlines:
-        print line
-    if not match:
-      return False
-  else:
-    raise ValueError('Unexpected element type: %s' % type(a))
-  return True
+      print '+\t%s' % show(op['value'])
+
+
+def jsondiff(a, b, verbose=True):
+  patch = jsonpatch(a, b)
+  if verbose:
+    print_jsonpatch(patch)
+  return not patch
 
 
 def Test():
@@ -208,6 +315,41 @@ def Test():
   assert(jsondiff(rcopy, r, verbose=False) == False)
   jpath_delete(r, 'newrootlist')
   assert(jsondiff(rcopy, r, verbose=True) == True)
+  # Compiled paths are reusable across documents.
+  fields = JPath('testroot/testroot1')
+  second = JPath('/testroot/testroot1/1/list2/')
+  assert(fields.get(r) == [{'list1':1},{'list2':2}] and second.get(r) == 2)
+  assert(second.get(rcopy) == 2 and second.get({}) is None)
+  assert(jpath(r, second) == 2 and compile_path(second) is second)
+  JPath('testroot/testroot1/0').set(r, {'list0':0})
+  assert(jpath(r, 'testroot/testroot1/0/list0') == 0)
+  JPath('testroot/testroot1/0').delete(r)
+  assert(fields.get(r) == [{'list2':2}])
+  for i in xrange(JPATH_CACHE_SIZE+1):
+    compile_path('cache/%d' % i)
+  assert(len(_jpath_cache) <= JPATH_CACHE_SIZE)
+  r = copy.deepcopy(rcopy)
+  # Scalars compare like their JSON text.
+  assert(jsonpatch({'a':'caf\xc3\xa9', u'b':1}, {u'a':u'caf\xe9', 'b':1}) == [])
+  assert(jsonpatch({'x':True, 'y':1}, {'x':1, 'y':1.0}) == [
+    {'op':'replace', 'path':u'/x', 'old':True, 'value':1},
+    {'op':'replace', 'path':u'/y', 'old':1, 'value':1.0}])
+  # Fields line up by typeName around an inserted one.
+  fields = [{'typeName':'title', 'value':'T'},
+      {'typeName':'author', 'value':['A']},
+      {'typeName':'keyword', 'value':['k']}]
+  newfields = copy.deepcopy(fields)
+  newfields.insert(1, {'typeName':'subject', 'value':'S'})
+  newfields[3]['value'].append('k2')
+  assert(jsonpatch({'fields':fields}, {'fields':newfields}) == [
+    {'op':'add', 'path':u'/fields/1', 'value':newfields[1]},
+    {'op':'add', 'path':u'/fields/2/value/1', 'value':'k2'}])
+  del newfields[0]
+  patch = jsonpatch(fields, newfields)
+  assert([(x['op'], x['path']) for x in patch] == [('remove', u'/0'),
+    ('add', u'/0'), ('add', u'/2/value/1')])
+  print_jsonpatch(patch, printlen=20)
+  assert(jsonpatch({'a/b':{}}, {'a/b':[]})[0]['path'] == u'/a~1b')
   print 'Tests passed.'
  
 
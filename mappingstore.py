@@ -0,0 +1,392 @@
+'''mappingstore.py -- SQLite store of local ID, DOI and entity ID mappings.
+
+Copyright 2018 Garth Griffin
+Distributed under the GNU GPL v3. For full terms see the file LICENSE.
+
+This file is part of PetitionsDataverse.
+
+PetitionsDataverse is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version.
+
+PetitionsDataverse is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along with
+PetitionsDataverse.  If not, see <http://www.gnu.org/licenses/>.
+________________________________________________________________________________
+
+Author: Garth Griffin (http://garthgriffin.com)
+
+One table holds a row per DOI with its local ID and Dataverse entity ID, both
+optional since the entity ID cache also covers datasets without a local ID.
+The DOI is the primary key and local IDs are unique, so SQLite itself rejects
+a second mapping for either. The tsv and JSON files used elsewhere can be
+imported into a store and exported back out of it.
+'''
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import collections
+
+import jsonjournal
+import tsvfile
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mappings (
+  doi TEXT PRIMARY KEY,
+  local_id TEXT UNIQUE,
+  entity_id INTEGER
+)
+'''
+
+
+class _Conflicts(Exception):
+  # Rolls back an all_or_nothing batch in add_mappings.
+  pass
+
+
+class MappingStore(object):
+  '''MappingStore
+
+  Local ID, DOI and entity ID mappings in a SQLite database file.
+
+  One connection is shared by all threads and used by one at a time, so a
+  store can be shared by several workers, including the short-lived threads
+  of timeout.timeout, without opening a connection per thread. Every batch of
+  writes is a single transaction, which SQLite also runs one at a time
+  across processes.
+  '''
+
+  def __init__(self, db_file, timeout=60):
+    '''__init__
+
+    Opens the database, creating the file and table if needed.
+
+    Params:
+      db_file: Path of the SQLite database file.
+      timeout: Optional seconds to wait for another writer, default 60.
+    '''
+    self.db_file = db_file
+    self.timeout = timeout
+    # Guards the connection, which sqlite3 only lets one thread use at once.
+    self.lock = threading.RLock()
+    # Transactions are started explicitly in _transaction.
+    self.conn = sqlite3.connect(db_file, timeout=timeout,
+        isolation_level=None, check_same_thread=False)
+    self.conn.text_factory = str
+    # The write-ahead log lets other processes read while a batch is written.
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.execute(SCHEMA)
+
+  def _query(self, sql, params=()):
+    with self.lock:
+      return self.conn.execute(sql, params).fetchall()
+
+  def _transaction(self, func):
+    # Takes the write lock up front, so batches from other processes wait for
+    # each other instead of failing when both try to upgrade a read lock.
+    with self.lock:
+      self.conn.execute('BEGIN IMMEDIATE')
+      try:
+        result = func(self.conn)
+      except:
+        self.conn.execute('ROLLBACK')
+        raise
+      self.conn.execute('COMMIT')
+      return result
+
+  def _get(self, column, key_column, key):
+    rows = self._query('SELECT %s FROM mappings WHERE %s = ?' % (
+      column, key_column), (key,))
+    return rows[0][0] if rows else None
+
+  def get_doi(self, local_id):
+    return self._get('doi', 'local_id', local_id)
+
+  def get_local_id(self, doi):
+    return self._get('local_id', 'doi', doi)
+
+  def get_entity_id(self, doi):
+    return self._get('entity_id', 'doi', doi)
+
+  def __len__(self):
+    return self._query('SELECT COUNT(*) FROM mappings')[0][0]
+
+  def doi_map(self):
+    '''doi_map
+
+    Returns a dict of every local ID to its DOI.
+    '''
+    return dict(self._query('SELECT local_id, doi FROM mappings '
+      'WHERE local_id IS NOT NULL'))
+
+  def add_mapping(self, local_id, doi):
+    '''add_mapping
+
+    Maps a local ID to a DOI, raising ValueError if either is already mapped
+    to something else.
+
+    Params:
+      local_id: The local ID.
+      doi: The DOI.
+
+    Returns:
+      True if the mapping is new, False if it was already there.
+    '''
+    counters, conflicts = self.add_mappings([(local_id, doi)])
+    if conflicts:
+      unused_i, local_id, doi, conflict, existing = conflicts[0]
+      raise ValueError('Cannot map %s -> %s, %s already mapped to %s' % (
+        local_id, doi, conflict, existing))
+    return counters['update'] == 1
+
+  def add_mappings(self, pairs, all_or_nothing=False):
+    '''add_mappings
+
+    Maps local IDs to DOIs in one transaction.
+
+    A pair conflicts if its local ID or its DOI is already mapped to something
+    else, including by an earlier pair in the same batch. Conflicting pairs
+    are skipped.
+
+    Params:
+      pairs: Iterable of (local ID, DOI) tuples.
+      all_or_nothing: Optional boolean, write nothing if any pair conflicts.
+
+    Returns:
+      Tuple of a counters dict with keys total, update, preexisting and
+      conflict, and a list of conflicts, each a tuple of (index in pairs,
+      local ID, DOI, 'Local ID' or 'DOI' for the column already mapped, and
+      the value it is mapped to).
+    '''
+    counters = collections.defaultdict(int)
+    conflicts = []
+    def write(conn):
+      for i, (local_id, doi) in enumerate(pairs):
+        counters['total'] += 1
+        row = conn.execute('SELECT local_id FROM mappings WHERE doi = ?',
+            (doi,)).fetchone()
+        try:
+          if row is not None and row[0] is None:
+            # Known from the entity ID cache, but not mapped to a local ID yet.
+            conn.execute('UPDATE mappings SET local_id = ? WHERE doi = ?',
+                (local_id, doi))
+          else:
+            conn.execute('INSERT INTO mappings (doi, local_id) VALUES (?, ?)',
+                (doi, local_id))
+          counters['update'] += 1
+          continue
+        except sqlite3.IntegrityError:
+          pass
+        existing_doi = conn.execute(
+            'SELECT doi FROM mappings WHERE local_id = ?',
+            (local_id,)).fetchone()
+        if existing_doi is not None and existing_doi[0] == doi:
+          counters['preexisting'] += 1
+        elif existing_doi is not None:
+          counters['conflict'] += 1
+          conflicts.append((i, local_id, doi, 'Local ID', existing_doi[0]))
+        else:
+          counters['conflict'] += 1
+          conflicts.append((i, local_id, doi, 'DOI', row[0]))
+      if conflicts and all_or_nothing:
+        raise _Conflicts()
+    try:
+      self._transaction(write)
+    except _Conflicts:
+      counters['update'] = 0
+    return counters, conflicts
+
+  def set_entity_id(self, doi, entity_id):
+    self.set_entity_ids({doi:entity_id})
+
+  def set_entity_ids(self, entity_ids):
+    '''set_entity_ids
+
+    Sets the entity IDs of several DOIs in one transaction.
+
+    Params:
+      entity_ids: A dict or an iterable of (DOI, entity ID) pairs.
+    '''
+    if isinstance(entity_ids, dict):
+      entity_ids = entity_ids.iteritems()
+    def write(conn):
+      for doi, entity_id in entity_ids:
+        cursor = conn.execute(
+            'UPDATE mappings SET entity_id = ? WHERE doi = ?',
+            (entity_id, doi))
+        if cursor.rowcount == 0:
+          conn.execute('INSERT INTO mappings (doi, entity_id) VALUES (?, ?)',
+              (doi, entity_id))
+    self._transaction(write)
+
+  def entity_id_map(self):
+    '''entity_id_map
+
+    Returns a dict of every DOI with a known entity ID to that entity ID.
+    '''
+    return dict(self._query('SELECT doi, entity_id FROM mappings '
+      'WHERE entity_id IS NOT NULL'))
+
+  def import_tsv(self, infile, all_or_nothing=False):
+    '''import_tsv
+
+    Adds the mappings of a local ID to DOI tsv file, e.g. local_id_to_doi.tsv.
+
+    See also: add_mappings
+
+    Params:
+      infile: Path of a tsv file with Local ID and DOI columns.
+      all_or_nothing: Optional boolean, import nothing if any row conflicts.
+
+    Returns:
+      The counters and conflicts of add_mappings.
+    '''
+    counters, conflicts = self.add_mappings(
+        tsvfile.IterTuples(infile, ['Local ID', 'DOI']), all_or_nothing)
+    print 'Imported %s from file: %s' % (dict(counters), infile)
+    return counters, conflicts
+
+  def export_tsv(self, outfile):
+    '''export_tsv
+
+    Writes the local ID to DOI mappings to a tsv file in the order they were
+    added, in the format of local_id_to_doi.tsv.
+
+    Params:
+      outfile: Path of the output tsv file.
+    '''
+    rows = [{'Local ID':local_id, 'DOI':doi} for local_id, doi in
+        self._query('SELECT local_id, doi FROM mappings '
+          'WHERE local_id IS NOT NULL ORDER BY rowid')]
+    tsvfile.WriteDicts(outfile, rows)
+
+  def import_entity_ids(self, json_file):
+    '''import_entity_ids
+
+    Adds the entity IDs of an entity ID cache, e.g. dataverse_entity_ids.json,
+    including entries still in its journal.
+
+    Params:
+      json_file: Path of the JSON entity ID cache.
+    '''
+    journal = jsonjournal.JsonJournal(json_file, compact_on_load=False)
+    self.set_entity_ids(journal.data)
+    print 'Imported %d entity IDs from file: %s' % (len(journal), json_file)
+
+  def export_entity_ids(self, json_file):
+    '''export_entity_ids
+
+    Writes the entity IDs to a JSON file in the format of the entity ID cache.
+    The file is replaced atomically.
+
+    Params:
+      json_file: Path of the output JSON file.
+    '''
+    entity_ids = self.entity_id_map()
+    temp_path = tsvfile.MakeTempPath(json_file)
+    with open(temp_path, 'wb') as fid:
+      fid.write(json.dumps(entity_ids, indent=2, sort_keys=True))
+      fid.flush()
+      os.fsync(fid.fileno())
+    os.rename(temp_path, json_file)
+    print 'Wrote %d entity IDs to file: %s' % (len(entity_ids), json_file)
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
+
+
+def Test():
+  import shutil
+  tempdir = tempfile.mkdtemp()
+  try:
+    db_file = os.path.join(tempdir, 'mappings.db')
+    master = os.path.join(tempdir, 'local_id_to_doi.tsv')
+    tsvfile.WriteDicts(master, [
+      {'Local ID':'id1', 'DOI':'doi:1'},
+      {'Local ID':'id2', 'DOI':'doi:2'},
+      ])
+    store = MappingStore(db_file)
+    counters, conflicts = store.import_tsv(master)
+    assert(counters['update'] == 2 and not conflicts)
+    assert(store.get_doi('id1') == 'doi:1')
+    assert(store.get_local_id('doi:2') == 'id2')
+    assert(store.get_doi('id3') is None)
+    # Conflicts with the store and within the batch are both caught.
+    counters, conflicts = store.add_mappings([('id1', 'doi:1'),
+      ('id1', 'doi:9'), ('id9', 'doi:2'), ('id3', 'doi:3'), ('id4', 'doi:3')])
+    assert(dict(counters) == {'total':5, 'update':1, 'preexisting':1,
+      'conflict':3})
+    assert(conflicts == [(1, 'id1', 'doi:9', 'Local ID', 'doi:1'),
+      (2, 'id9', 'doi:2', 'DOI', 'id2'), (4, 'id4', 'doi:3', 'DOI', 'id3')])
+    counters, conflicts = store.add_mappings([('id5', 'doi:5'),
+      ('id5', 'doi:6')], all_or_nothing=True)
+    assert(counters['update'] == 0 and len(conflicts) == 1)
+    assert(store.get_doi('id5') is None)
+    try:
+      store.add_mapping('id1', 'doi:7')
+      assert(False)
+    except ValueError:
+      pass
+    # Entity IDs can be known before the local ID is.
+    cache = os.path.join(tempdir, 'dataverse_entity_ids.json')
+    with open(cache, 'w') as fid:
+      fid.write(json.dumps({'doi:1':11, 'doi:8':18}))
+    store.import_entity_ids(cache)
+    assert(store.get_entity_id('doi:1') == 11)
+    assert(store.add_mapping('id8', 'doi:8'))
+    assert(store.get_entity_id('doi:8') == 18)
+    # Batches from several threads.
+    def add(n):
+      store.add_mappings([('t%d.%d' % (n, i), 'doi:t%d.%d' % (n, i))
+        for i in xrange(50)])
+      store.set_entity_ids(dict(('doi:t%d.%d' % (n, i), i) for i in
+        xrange(50)))
+    threads = [threading.Thread(target=add, args=(n,)) for n in xrange(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert(len(store) == 4 + 200)
+    # Lookups from many short-lived threads, as when every row of update.py
+    # runs under timeout.timeout, share the one connection.
+    def lookup(n):
+      assert(store.get_doi('t%d.%d' % (n % 4, n % 50)) ==
+          'doi:t%d.%d' % (n % 4, n % 50))
+    for n in xrange(500):
+      t = threading.Thread(target=lookup, args=(n,))
+      t.start()
+      t.join()
+    if os.path.isdir('/proc/self/fd'):
+      num_fds = len(os.listdir('/proc/self/fd'))
+      for n in xrange(100):
+        t = threading.Thread(target=lookup, args=(n,))
+        t.start()
+        t.join()
+      assert(len(os.listdir('/proc/self/fd')) == num_fds)
+    store.export_tsv(master)
+    rows = tsvfile.ReadDicts(master)
+    assert([x['Local ID'] for x in rows[:4]] == ['id1', 'id2', 'id3', 'id8'])
+    assert(len(rows) == 204)
+    os.chmod(cache, 0640)
+    store.export_entity_ids(cache)
+    assert(os.stat(cache).st_mode & 0777 == 0640)
+    with open(cache) as fid:
+      assert(json.loads(fid.read()) == store.entity_id_map())
+    store.close()
+    store = MappingStore(db_file)
+    assert(store.doi_map() == dict((x['Local ID'], x['DOI']) for x in rows))
+    store.close()
+  finally:
+    shutil.rmtree(tempdir)
+  print 'Tests passed.'
+
+
+if __name__ == '__main__':
+  Test()
@@ -23,17 +23,38 @@ Author: Garth Griffin (http://garthgriffin.com)
 Date: February 23 2018
 '''
 import sys
+import optparse
 import collections
 
 import tsvfile
+import mappingstore
 
-merge_into_tsv = sys.argv[1]
-merge_new_tsvs = sys.argv[2:]
 
-def merge(merge_into_tsv, merge_new_tsv):
-  print 'Merge %s <-- %s' % (merge_into_tsv, merge_new_tsv)
+def conflict_row(merge_new_tsv, row_number, local_id, doi, conflict,
+    existing):
+  print 'Conflicted %s in %s row %d: %s -> %s, already mapped to %s' % (
+      conflict, merge_new_tsv, row_number, local_id, doi, existing)
+  return {
+      'File':merge_new_tsv,
+      'Row':row_number,
+      'Local ID':local_id,
+      'DOI':doi,
+      'Conflict':conflict,
+      'Existing':existing,
+      }
+
+def add_counters(counters, file_counters):
+  for key, value in file_counters.iteritems():
+    counters[key] += value
+
+def abort_on_conflicts(merge_new_tsv, conflicts):
+  raise ValueError('Found %d conflicts in %s, nothing merged from it or the '
+      'files after it. Use --conflict_report to merge the rest and list the '
+      'conflicts.' % (len(conflicts), merge_new_tsv))
+
+def merge_all(merge_into_tsv, merge_new_tsvs, conflict_report_tsv=None):
+  print 'Merge %s <-- %s' % (merge_into_tsv, ', '.join(merge_new_tsvs))
   rows = tsvfile.ReadDicts(merge_into_tsv)
-  update_rows = tsvfile.ReadDicts(merge_new_tsv)
 
   prev_map_id = dict([(x['Local ID'], x['DOI']) for x in rows])
   prev_map_doi = dict([(x['DOI'], x['Local ID']) for x in rows])
@@ -43,31 +64,178 @@ def merge(merge_into_tsv, merge_new_tsv):
   if len(prev_map_doi) != len(rows):
     raise ValueError('Non-unique DOIs in %s' % merge_into_tsv)
 
-  counters = collections.defaultdict(int)
-  for row in update_rows:
-    counters['total'] += 1
-    local_id = row['Local ID']
-    doi = row['DOI']
-    needs_update = True
-    if local_id in prev_map_id:
-      if prev_map_id[local_id] != doi:
-        raise ValueError('Conflicted local ID in %s: %s' % (
-          merge_new_tsv, local_id))
-      needs_update = False
-    if doi in prev_map_doi:
-      if prev_map_doi[doi] != local_id:
-        raise ValueError('Conflicted DOI in %s: %s' % (merge_new_tsv, doi))
-      needs_update = False
-    if needs_update:
-      counters['update'] += 1
-      prev_map_id[local_id] = doi
-      prev_map_doi[doi] = local_id
-      rows.append(row)
+  def write_rows():
+    if counters['update']:
+      tsvfile.WriteDicts(merge_into_tsv, rows)
     else:
-      counters['preexisting'] += 1
+      print 'No new entries for: %s' % merge_into_tsv
+
+  # Update files are merged in order, each checked against the master map and
+  # the files before it, so the first file to map a local ID or DOI wins.
+  # Without a conflict report, a file with conflicts stops the merge, and only
+  # the files before it are written.
+  counters = collections.defaultdict(int)
+  conflicts = []
+  for merge_new_tsv in merge_new_tsvs:
+    file_counters = collections.defaultdict(int)
+    file_conflicts = []
+    file_rows = []
+    update_rows = tsvfile.IterTuples(merge_new_tsv, ['Local ID', 'DOI'])
+    for row_number, (local_id, doi) in enumerate(update_rows, 1):
+      file_counters['total'] += 1
+      needs_update = True
+      conflict = None
+      if local_id in prev_map_id:
+        if prev_map_id[local_id] != doi:
+          conflict = ('Local ID', prev_map_id[local_id])
+        needs_update = False
+      if doi in prev_map_doi:
+        if prev_map_doi[doi] != local_id:
+          conflict = conflict or ('DOI', prev_map_doi[doi])
+        needs_update = False
+      if conflict is not None:
+        file_counters['conflict'] += 1
+        file_conflicts.append(conflict_row(merge_new_tsv, row_number, local_id,
+          doi, conflict[0], conflict[1]))
+      elif needs_update:
+        file_counters['update'] += 1
+        prev_map_id[local_id] = doi
+        prev_map_doi[doi] = local_id
+        file_rows.append({'Local ID':local_id, 'DOI':doi})
+      else:
+        file_counters['preexisting'] += 1
+    print '%s: %s' % (merge_new_tsv, dict(file_counters))
+    if file_conflicts and conflict_report_tsv is None:
+      write_rows()
+      abort_on_conflicts(merge_new_tsv, file_conflicts)
+    add_counters(counters, file_counters)
+    conflicts.extend(file_conflicts)
+    rows.extend(file_rows)
 
   print str(dict(counters))
-  tsvfile.WriteDicts(merge_into_tsv, rows)
+  if conflicts:
+    tsvfile.WriteDicts(conflict_report_tsv, conflicts)
+  write_rows()
+  return counters
+
+def merge_all_into_store(mapping_db, merge_into_tsv, merge_new_tsvs,
+    conflict_report_tsv=None):
+  # Same as merge_all, but the merge happens in a mappingstore.MappingStore,
+  # whose uniqueness constraints find the conflicts. The master tsv is
+  # imported into the store first and exported from it afterwards, so it
+  # also picks up mappings added to the store by update.py --mapping_db.
+  print 'Merge %s <-- %s in %s' % (merge_into_tsv, ', '.join(merge_new_tsvs),
+      mapping_db)
+  store = mappingstore.MappingStore(mapping_db)
+  try:
+    master_counters, conflicts = store.import_tsv(merge_into_tsv,
+        all_or_nothing=True)
+    if conflicts:
+      raise ValueError('%s conflicts with %s: %s' % (merge_into_tsv,
+        mapping_db, conflicts[0]))
+
+    def export_rows():
+      if len(store.doi_map()) != master_counters['total']:
+        store.export_tsv(merge_into_tsv)
+      else:
+        print 'No new entries for: %s' % merge_into_tsv
+
+    counters = collections.defaultdict(int)
+    conflict_rows = []
+    for merge_new_tsv in merge_new_tsvs:
+      # Each file is one transaction, rolled back on a conflict if there is
+      # no report to list it in.
+      file_counters, file_conflicts = store.add_mappings(
+          tsvfile.IterTuples(merge_new_tsv, ['Local ID', 'DOI']),
+          all_or_nothing=conflict_report_tsv is None)
+      print '%s: %s' % (merge_new_tsv, dict(file_counters))
+      file_conflict_rows = [conflict_row(merge_new_tsv, i+1, local_id, doi,
+        conflict, existing)
+        for i, local_id, doi, conflict, existing in file_conflicts]
+      if file_conflicts and conflict_report_tsv is None:
+        export_rows()
+        abort_on_conflicts(merge_new_tsv, file_conflict_rows)
+      add_counters(counters, file_counters)
+      conflict_rows.extend(file_conflict_rows)
+    print str(dict(counters))
+    if conflict_rows:
+      tsvfile.WriteDicts(conflict_report_tsv, conflict_rows)
+    export_rows()
+  finally:
+    store.close()
+  return counters
+
+def merge(merge_into_tsv, merge_new_tsv):
+  return merge_all(merge_into_tsv, [merge_new_tsv])
+
+
+def Test():
+  import os
+  import shutil
+  import tempfile
+  tempdir = tempfile.mkdtemp()
+  def path(name):
+    return os.path.join(tempdir, name)
+  def write(name, pairs):
+    tsvfile.WriteDicts(path(name), [{'Local ID':x, 'DOI':y} for x, y in pairs])
+  def read(name):
+    return list(tsvfile.IterTuples(path(name), ['Local ID', 'DOI']))
+  master = [('a', 'd1'), ('b', 'd2')]
+  write('ok.tsv', [('c', 'd3'), ('a', 'd1')])
+  write('bad.tsv', [('e', 'd5'), ('a', 'd9'), ('z', 'd2'), ('c', 'd6')])
+  write('after.tsv', [('f', 'd7')])
+  try:
+    for merge_func in [merge_all, lambda *args: merge_all_into_store(
+        path('mappings.db'), *args)]:
+      # Without a report, the files before a conflicting one are merged.
+      write('master.tsv', master)
+      if os.path.exists(path('mappings.db')):
+        os.remove(path('mappings.db'))
+      try:
+        merge_func(path('master.tsv'),
+            [path('ok.tsv'), path('bad.tsv'), path('after.tsv')])
+        assert(False)
+      except ValueError:
+        pass
+      assert(read('master.tsv') == master + [('c', 'd3')])
+      # With a report, only the conflicting rows are left out.
+      write('master.tsv', master)
+      if os.path.exists(path('mappings.db')):
+        os.remove(path('mappings.db'))
+      counters = merge_func(path('master.tsv'),
+          [path('ok.tsv'), path('bad.tsv'), path('after.tsv')],
+          path('conflicts.tsv'))
+      assert(dict(counters) == {'total':7, 'update':3, 'preexisting':1,
+        'conflict':3})
+      assert(read('master.tsv') == master + [('c', 'd3'), ('e', 'd5'),
+        ('f', 'd7')])
+      assert(list(tsvfile.IterTuples(path('conflicts.tsv'),
+        ['Row', 'Conflict', 'Existing'])) == [('2', 'Local ID', 'd1'),
+          ('3', 'DOI', 'b'), ('4', 'Local ID', 'd3')])
+  finally:
+    shutil.rmtree(tempdir)
+  print 'Tests passed.'
+
 
-for f in merge_new_tsvs:
-  merge(merge_into_tsv, f)
+if __name__ == '__main__':
+  parser = optparse.OptionParser(
+      usage='%prog [options] MERGE_INTO_TSV UPDATE_TSV [UPDATE_TSV ...]')
+  parser.add_option('--conflict_report',
+      help='Skip conflicting rows and write them to this tsv file instead of '
+      'aborting the merge.')
+  parser.add_option('--mapping_db',
+      help='Merge in this SQLite mapping store (see mappingstore.py) and '
+      'export the result to MERGE_INTO_TSV.')
+  parser.add_option('--test', action='store_true', default=False,
+      help='Run built-in tests of this module.')
+  options, args = parser.parse_args()
+  if options.test:
+    Test()
+    sys.exit(0)
+  if len(args) < 2:
+    parser.error('Expected a file to merge into and at least one update file.')
+  if options.mapping_db:
+    merge_all_into_store(options.mapping_db, args[0], args[1:],
+        options.conflict_report)
+  else:
+    merge_all(args[0], args[1:], options.conflict_report)
@@ -24,6 +24,7 @@ February 23 2018
 '''
 import traceback
 import sys
+import optparse
 import os
 import re
 import collections
@@ -42,15 +43,29 @@ resolver_fields = [
     ]
 
 
-def resolve(dataverse_helper_instance, row):
-  description_html = row['Description']
+def description_fields(description_html):
   query_parts = description_html.split('</p>')
   query_parts_text = filter(None, [
       re.sub(r'  *', ' ', re.sub(r'<[^>]*>', ' ', x).strip())
       for x in query_parts])
-  query_parts_text_filter = filter(
+  return filter(
       lambda x: any([x.startswith(y) for y in resolver_fields]),
       query_parts_text)
+
+
+def description_tokens(description):
+  '''description_tokens
+
+  Returns the lowercase words of a description, without HTML tags.
+  '''
+  if isinstance(description, str):
+    description = description.decode('utf-8', 'replace')
+  return re.findall(r'\w+', re.sub(r'<[^>]*>', ' ', description).lower(),
+      re.UNICODE)
+
+
+def resolve(dataverse_helper_instance, row):
+  query_parts_text_filter = description_fields(row['Description'])
   min_field_count = len(resolver_fields) - 2
   if len(query_parts_text_filter) < min_field_count:
     print 'Not enough query fields (found %d, need %d)' % (
@@ -61,22 +76,218 @@ def resolve(dataverse_helper_instance, row):
   return doi
 
 
+class LocalResolver(object):
+  '''LocalResolver
+
+  Resolves rows to DOIs in memory using an inverted index of descriptions.
+
+  A row matches a dataset whose description contains each of the row's
+  resolver_fields paragraphs as a phrase, the same query resolve() sends to
+  the search. Like the search, phrases are compared word by word, so it does
+  not matter whether the description is HTML or the plain text returned by
+  the search, or which other paragraphs it has. The index maps each word to
+  the DOIs containing it, to find the candidates to check for the phrases.
+  '''
+
+  def __init__(self, datasets):
+    '''__init__
+
+    Params:
+      datasets: Iterable of (doi, description) pairs to index.
+    '''
+    self.index = collections.defaultdict(set)
+    self.texts = {}
+    for doi, description in datasets:
+      tokens = description_tokens(description or '')
+      # Padded so a phrase only matches whole words.
+      self.texts[doi] = u' %s ' % u' '.join(tokens)
+      for token in tokens:
+        self.index[token].add(doi)
+    print 'Indexed %d words from %d datasets.' % (
+        len(self.index), len(self.texts))
+
+  @staticmethod
+  def from_dataverse(dataverse_helper_instance):
+    '''from_dataverse
+
+    Builds the index from a paged search of every dataset in the dataverse.
+    '''
+    return LocalResolver(
+        (x['global_id'], x.get('description', ''))
+        for x in dataverse_helper_instance.iter_datasets()
+        if x.get('global_id'))
+
+  def match(self, row):
+    '''match
+
+    Returns the set of DOIs matching the row, or None with too few fields.
+    '''
+    parts = description_fields(row['Description'])
+    if len(parts) < len(resolver_fields) - 2:
+      return None
+    phrases = [description_tokens(x) for x in parts]
+    words = set(x for phrase in phrases for x in phrase)
+    # Intersect the smallest posting lists first.
+    postings = sorted([self.index.get(x, set()) for x in words], key=len)
+    matches = set(postings[0]) if postings else set()
+    for posting in postings[1:]:
+      if not matches:
+        break
+      matches &= posting
+    phrases = [u' %s ' % u' '.join(x) for x in phrases]
+    return set(doi for doi in matches
+        if all(x in self.texts[doi] for x in phrases))
+
+  def resolve(self, row):
+    matches = self.match(row)
+    if matches is None or len(matches) != 1:
+      return None
+    return iter(matches).next()
+
+  def resolve_all(self, rows):
+    '''resolve_all
+
+    Resolves many rows at once.
+
+    Params:
+      rows: The rows to resolve, which must have Local ID and Description.
+
+    Returns:
+      Tuple of (resolved, ambiguous, missing): a dict of Local ID to DOI, a
+      dict of Local ID to the sorted list of matching DOIs, and a list of
+      Local IDs with no match or too few fields to match.
+    '''
+    resolved = {}
+    ambiguous = {}
+    missing = []
+    for row in rows:
+      local_id = row['Local ID']
+      matches = self.match(row)
+      if not matches:
+        missing.append(local_id)
+      elif len(matches) > 1:
+        ambiguous[local_id] = sorted(matches)
+      else:
+        resolved[local_id] = iter(matches).next()
+    return resolved, ambiguous, missing
+
+
+def Test():
+  def description(subject, signatures, total):
+    # Built like the descriptions written by antislaverypetitions.
+    return ''.join([
+      '<p>Petition of sundry inhabitants of Boston against the admission of '
+      'Texas as a slave state.</p>',
+      '<p>Date of creation: 1838-02-12 </p>',
+      '<p>Petition subject: %s </p>' % subject,
+      '<p>Original: <a href="http://nrs.harvard.edu/urn-3:FHCL:1">'
+      'http://nrs.harvard.edu/urn-3:FHCL:1</a> </p>',
+      '<p>Petition location: Boston, Massachusetts </p>',
+      '<p>Actions taken on dates: 1838-02-20 </p>',
+      '<p>Legislator, committee, or address that the petition was sent to: '
+      'Massachusetts General Court </p>',
+      '<p>Selected signatures:<ol><li>John Smith</li><li>Mary Jones</li>'
+      '</ol> </p>' if signatures else '',
+      '<p>Total signatures: %d </p>' % total,
+      '<p>Female signatures: 40 </p>',
+      '<p>Acknowledgements: Supported by the National Endowment for the '
+      'Humanities.</p>',
+      ])
+  def plain(html):
+    # The search returns descriptions as text without the HTML tags.
+    return re.sub(r'<[^>]*>', '\n', html)
+  row = description('Slavery in Texas', True, 112)
+  other = description('Slavery in Texas', True, 113)
+  resolver = LocalResolver([
+    ('doi:a', plain(row)),
+    ('doi:b', other),
+    ('doi:c', plain(other)),
+    ('doi:d', description('Annexation of Texas', True, 112)),
+    ])
+  rows = [
+      {'Local ID':'a', 'Description':row},
+      {'Local ID':'bc', 'Description':other},
+      {'Local ID':'none', 'Description':description('Slavery', False, 1)[:200]},
+      {'Local ID':'miss', 'Description':description('Texas', True, 112)},
+      ]
+  assert(len(description_fields(row)) == len(resolver_fields))
+  assert(resolver.resolve(rows[0]) == 'doi:a')
+  resolved, ambiguous, missing = resolver.resolve_all(rows)
+  assert(resolved == {'a':'doi:a'})
+  assert(ambiguous == {'bc':['doi:b', 'doi:c']})
+  assert(missing == ['none', 'miss'])
+  print 'Tests passed.'
+
+
 if __name__ == '__main__':
-  api_key = sys.argv[1]  # `cat credentials.txt | tail -n 1`
-  dataset_tsv = sys.argv[2]  # ignored_outputs/studydata_*.tsv
-  entity_cache_file = sys.argv[3]  # dataverse_entity_ids.json
-  outfile = sys.argv[4]  # ...
+  parser = optparse.OptionParser(
+      usage='%prog API_KEY DATASET_TSV ENTITY_CACHE_FILE OUTFILE [options]')
+  parser.add_option('--dataverse_name', default='',
+      help='Name of the Dataverse to search, needed by --prefetch_entity_ids '
+      'and --local_index.')
+  parser.add_option('--prefetch_entity_ids', action='store_true',
+      default=False,
+      help='Fill the entity ID cache from a paged search of the Dataverse.')
+  parser.add_option('--local_index', action='store_true', default=False,
+      help='Download all dataset descriptions once and resolve in memory.')
+  parser.add_option('--test', action='store_true', default=False,
+      help='Run built-in tests of this module.')
+  options, args = parser.parse_args()
+  if options.test:
+    Test()
+    sys.exit(0)
+  if len(args) != 4:
+    parser.error('Expected 4 positional arguments, got %d' % len(args))
+  if ((options.prefetch_entity_ids or options.local_index) and
+      not options.dataverse_name):
+    parser.error('--prefetch_entity_ids and --local_index need '
+        '--dataverse_name, or they would search all of the server.')
+  api_key = args[0]  # `cat credentials.txt | tail -n 1`
+  dataset_tsv = args[1]  # ignored_outputs/studydata_*.tsv
+  entity_cache_file = args[2]  # dataverse_entity_ids.json
+  outfile = args[3]  # ...
 
   cache = {}
-  output_rows = []
-  if os.path.isfile(outfile):
+  outfile_exists = os.path.isfile(outfile)
+  # New rows are appended, after dropping a line cut off by an interruption.
+  output = tsvfile.TsvAppender(outfile, ['DOI', 'Local ID'])
+  if outfile_exists:
     print 'Outfile exists, reading finished rows...'
-    output_rows = tsvfile.ReadDicts(outfile)
-    cache = dict([(x['Local ID'], x['DOI']) for x in output_rows])
+    cache = dict(tsvfile.IterTuples(outfile, ['Local ID', 'DOI']))
     print 'Loaded %d prior entries from outfile: %s' % (len(cache), outfile)
 
-  rows = tsvfile.ReadDicts(dataset_tsv)
-  dvhelper = dataversehelper.DataverseHelper(api_key, entity_cache_file)
+  # Only these columns are used to resolve, out of the whole study data.
+  rows = tsvfile.ReadDicts(dataset_tsv, ['Local ID', 'Description'])
+  dvhelper = dataversehelper.DataverseHelper(api_key, options.dataverse_name,
+      entity_id_cache_file=entity_cache_file)
+  if options.prefetch_entity_ids:
+    dvhelper.prefetch_entity_ids()
+
+  if options.local_index:
+    pending = [x for x in rows if x['Local ID'] not in cache]
+    print 'Resolving %d uncached rows with a local index...' % len(pending)
+    resolver = LocalResolver.from_dataverse(dvhelper)
+    resolved, ambiguous, missing = resolver.resolve_all(pending)
+    for local_id, doi in sorted(resolved.items()):
+      print '%s -> %s' % (local_id, doi)
+      output.Write({
+        'DOI':doi,
+        'Local ID':local_id
+        })
+    output.Close()
+    for local_id, dois in sorted(ambiguous.items()):
+      print 'AMBIGUOUS %s -> %s' % (local_id, ', '.join(dois))
+    for local_id in missing:
+      print 'MISSING %s -> ???' % local_id
+    print 'Finished %d rows' % len(rows)
+    print str({
+      'total':len(rows),
+      'skip':len(rows) - len(pending),
+      'success':len(resolved),
+      'ambiguous':len(ambiguous),
+      'failure':len(missing),
+      })
+    sys.exit(0)
 
   counters = collections.defaultdict(int)
   ctr = 0
@@ -98,16 +309,16 @@ if __name__ == '__main__':
         continue
       counters['success'] += 1
       print '%s -> %s' % (local_id, doi)
-      output_rows.append({
+      output.Write({
         'DOI':doi,
         'Local ID':local_id
         })
-      tsvfile.WriteDicts(outfile, output_rows)
     except KeyboardInterrupt: raise KeyboardInterrupt
     except SystemExit: raise SystemExit
     except:
       print 'ERROR: %s' % traceback.format_exc()
       counters['error'] += 1
 
+  output.Close()
   print 'Finished %d rows' % len(rows)
   print str(dict(counters))
@@ -0,0 +1,243 @@
+'''pipeline.py -- Run items through stages of worker threads.
+
+Copyright 2018 Garth Griffin
+Distributed under the GNU GPL v3. For full terms see the file LICENSE.
+
+This file is part of PetitionsDataverse.
+
+PetitionsDataverse is free software: you can redistribute it and/or
+modify it under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your option)
+any later version.
+
+PetitionsDataverse is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+more details.
+
+You should have received a copy of the GNU General Public License along with
+PetitionsDataverse.  If not, see <http://www.gnu.org/licenses/>.
+________________________________________________________________________________
+
+Author: Garth Griffin (http://garthgriffin.com)
+
+Each stage has its own threads and takes items from a bounded queue filled by
+the stage before it, so a slow stage holds back only as many items as its
+queue has room for while the earlier stages keep working on the next ones.
+'''
+import threading
+import time
+import traceback
+import Queue
+
+
+# Put on a stage queue once per worker thread to stop the stage.
+_STOP = object()
+
+
+class Stage(object):
+  '''Stage
+
+  One step of a StagedPipeline.
+
+  The function is called with an item and returns the item for the next
+  stage, or None if the item needs no further stages.
+  '''
+
+  def __init__(self, name, func, workers=1, queue_size=None):
+    '''__init__
+
+    Params:
+      name: Name of the stage used in the counters.
+      func: Function taking an item and returning an item or None.
+      workers: Optional number of threads running func, default 1.
+      queue_size: Optional number of items waiting for this stage, default
+        twice the number of workers.
+    '''
+    self.name = name
+    self.func = func
+    self.workers = workers
+    self.queue = Queue.Queue(queue_size or 2*workers)
+    self.lock = threading.Lock()
+    self.counters = {'in':0, 'out':0, 'done':0, 'error':0,
+        'callback_error':0, 'busy_seconds':0.0}
+
+  def count(self, key, amount=1):
+    with self.lock:
+      self.counters[key] += amount
+
+
+class StagedPipeline(object):
+  '''StagedPipeline
+
+  Runs items through a list of Stages, each with its own threads.
+
+  Items keep their order within a stage with one worker, but may overtake
+  each other in stages with several. An exception in a stage is passed to
+  on_error and drops the item. An exception in on_error or on_done is
+  printed and counted as a callback_error of the stage, so the worker keeps
+  going.
+  '''
+
+  def __init__(self, stages, on_error=None, on_done=None):
+    '''__init__
+
+    Params:
+      stages: List of Stage objects in the order items pass through them.
+      on_error: Optional function called with (stage, item, exception) when
+        a stage raises. Defaults to printing the traceback.
+      on_done: Optional function called with (stage, item) when an item
+        leaves the pipeline, either after the last stage or because a stage
+        returned None.
+    '''
+    self.stages = stages
+    self.on_error = on_error or self._print_error
+    self.on_done = on_done
+    self.start_time = None
+
+  @staticmethod
+  def _print_error(stage, item, e):
+    print 'ERROR in stage %s: %s' % (stage.name, traceback.format_exc())
+
+  def _callback(self, stage, func, *args):
+    # A worker that died here would leave its queue full and the stages
+    # before it blocked forever.
+    try:
+      func(stage, *args)
+    except KeyboardInterrupt: raise KeyboardInterrupt
+    except SystemExit: raise SystemExit
+    except Exception:
+      stage.count('callback_error')
+      print 'ERROR in callback of stage %s: %s' % (stage.name,
+          traceback.format_exc())
+
+  def _work(self, i):
+    stage = self.stages[i]
+    next_stage = self.stages[i+1] if i+1 < len(self.stages) else None
+    while True:
+      item = stage.queue.get()
+      if item is _STOP:
+        return
+      stage.count('in')
+      start = time.time()
+      try:
+        result = stage.func(item)
+      except KeyboardInterrupt: raise KeyboardInterrupt
+      except SystemExit: raise SystemExit
+      except Exception, e:
+        stage.count('busy_seconds', time.time()-start)
+        stage.count('error')
+        self._callback(stage, self.on_error, item, e)
+        continue
+      stage.count('busy_seconds', time.time()-start)
+      if result is None or next_stage is None:
+        stage.count('done')
+        if self.on_done is not None:
+          self._callback(stage, self.on_done, item if result is None else
+              result)
+      else:
+        stage.count('out')
+        next_stage.queue.put(result)
+
+  def run(self, items):
+    '''run
+
+    Feeds items into the first stage and waits until all stages are done.
+
+    Params:
+      items: Iterable of items.
+    '''
+    self.start_time = time.time()
+    threads = []
+    for i, stage in enumerate(self.stages):
+      stage_threads = [threading.Thread(target=self._work, args=(i,),
+        name='%s-%d' % (stage.name, j)) for j in xrange(stage.workers)]
+      for t in stage_threads:
+        t.daemon = True
+        t.start()
+      threads.append(stage_threads)
+    feeder = threading.Thread(target=self._feed, args=(items,), name='feed')
+    feeder.daemon = True
+    feeder.start()
+    self._join([feeder])
+    # Stop each stage once the one before it has finished.
+    for stage, stage_threads in zip(self.stages, threads):
+      for unused_thread in stage_threads:
+        stage.queue.put(_STOP)
+      self._join(stage_threads)
+
+  def _feed(self, items):
+    first = self.stages[0]
+    for item in items:
+      first.queue.put(item)
+
+  @staticmethod
+  def _join(threads):
+    # Join with a timeout so KeyboardInterrupt still reaches the main thread.
+    while any(t.is_alive() for t in threads):
+      for t in threads:
+        t.join(1)
+
+  def report(self):
+    '''report
+
+    Returns a string of the counters and throughput of every stage.
+    '''
+    elapsed = max(time.time() - (self.start_time or time.time()), 1e-9)
+    lines = []
+    for stage in self.stages:
+      with stage.lock:
+        c = dict(stage.counters)
+      lines.append(
+          '%-10s in %5d  out %5d  done %5d  error %3d  callback error %3d  '
+          'busy %7.1fs  %.2f items/s' % (stage.name, c['in'], c['out'],
+            c['done'], c['error'], c['callback_error'], c['busy_seconds'],
+            c['in']/elapsed))
+    return '\n'.join(lines)
+
+
+def Test():
+  results = []
+  results_lock = threading.Lock()
+  errors = []
+  def double(x):
+    time.sleep(0.001)
+    return x*2
+  def drop_odd_thirds(x):
+    if x % 3 == 0: return None
+    if x == 14: raise ValueError('bad item')
+    return x
+  def collect(stage, item):
+    with results_lock:
+      results.append((stage.name, item))
+  pipe = StagedPipeline([
+      Stage('double', double, workers=3),
+      Stage('filter', drop_odd_thirds, queue_size=1),
+      Stage('last', lambda x: x+1),
+      ], on_error=lambda stage, item, e: errors.append((stage.name, item)),
+      on_done=collect)
+  pipe.run(xrange(10))
+  assert(errors == [('filter', 14)])
+  assert(sorted(x for s, x in results if s == 'filter') == [0, 6, 12, 18])
+  assert(sorted(x for s, x in results if s == 'last') == [3, 5, 9, 11, 17])
+  counters = [s.counters for s in pipe.stages]
+  assert([c['in'] for c in counters] == [10, 10, 5])
+  assert(counters[1]['done'] == 4 and counters[1]['error'] == 1)
+  print pipe.report()
+  # Failing callbacks are counted and do not stop the workers, which would
+  # block the feeder on the full queue of a one-item stage.
+  def fail(*args):
+    raise RuntimeError('callback failed')
+  pipe = StagedPipeline([
+      Stage('odd', lambda x: x if x % 2 else None, queue_size=1),
+      Stage('fail', lambda x: 1/0, queue_size=1),
+      ], on_error=fail, on_done=fail)
+  pipe.run(xrange(20))
+  counters = [s.counters for s in pipe.stages]
+  assert(counters[0]['done'] == 10 and counters[0]['callback_error'] == 10)
+  assert(counters[1]['error'] == 10 and counters[1]['callback_error'] == 10)
+  print 'Tests passed.'
+
+
+if __name__ == '__main__':
+  Test()
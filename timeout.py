@@ -22,40 +22,189 @@ ________________________________________________________________________________
 Author: Garth Griffin (http://garthgriffin.com)
 February 23 2018
 '''
-from functools import wraps
-import errno
-import os
-import signal  # Unix only.
+import sys
+import threading
+import time
+
 
 class TimeoutError(Exception):
   pass
 
-'''
-# WARNING: This is not thread-safe. Use only in single-threaded programs.
-def timeoutdecorator(seconds=10):
-  def decorator(func):
-    def _handle_timeout(signum, frame):
-      raise TimeoutError('Function timed out after %d seconds.' % seconds)
-
-    def wrapper(*args, **kwargs):
-      signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-              result = func(*args, **kwargs)
-            finally:
-              signal.alarm(0)
-            return result
-        return wraps(func)(wrapper)
-    return decorator
-'''
+
+# Each thread carries its own deadline, so tasks running in parallel do not
+# interfere with each other the way a process-wide SIGALRM handler would.
+_local = threading.local()
+
+
+class Deadline(object):
+  '''Deadline
+
+  A point in time by which a task must finish.
+
+  Code doing blocking work, such as HTTP requests, should call remaining() to
+  bound each call by the time left on the deadline of the current task.
+  '''
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+    self.expires_at = time.time() + seconds
+
+  def remaining(self):
+    return max(0.0, self.expires_at - time.time())
+
+  def expired(self):
+    return time.time() >= self.expires_at
+
+  def check(self):
+    if self.expired():
+      raise TimeoutError('Deadline of %g seconds exceeded.' % self.seconds)
+
+
+class deadline(object):
+  '''deadline
+
+  Context manager setting the deadline of the current thread.
+
+  Nested deadlines never extend an enclosing one: the earliest one wins.
+  '''
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+    self.previous = None
+
+  def __enter__(self):
+    self.previous = current_deadline()
+    new_deadline = Deadline(self.seconds)
+    if (self.previous is not None and
+        self.previous.expires_at < new_deadline.expires_at):
+      new_deadline = self.previous
+    _local.deadline = new_deadline
+    return new_deadline
+
+  def __exit__(self, exc_type, exc_value, tb):
+    _local.deadline = self.previous
+    return False
+
+
+def current_deadline():
+  return getattr(_local, 'deadline', None)
+
+
+def remaining():
+  '''remaining
+
+  Returns the seconds left for the current task, or None if it has no deadline.
+
+  Raises TimeoutError if the deadline has already passed, so no new blocking
+  call is started on behalf of a task that has been abandoned.
+  '''
+  current = current_deadline()
+  if current is None:
+    return None
+  current.check()
+  return current.remaining()
+
+
+def check():
+  '''check
+
+  Raises TimeoutError if the deadline of the current task has passed.
+
+  Call this before each step with side effects, such as a write to the server
+  or to local state, so an abandoned task stops before making it.
+  '''
+  current = current_deadline()
+  if current is not None:
+    current.check()
+
 
 def timeout(func, seconds=10):
-  def _handle(signum, frame):
-    raise TimeoutError('Function timed out after %d seconds.' % seconds)
-  signal.signal(signal.SIGALRM, _handle)
-  signal.alarm(seconds)
+  '''timeout
+
+  Runs func() with a deadline and raises TimeoutError if it does not finish.
+
+  This is thread-safe and can be called from any thread. The function runs in
+  a separate daemon thread carrying the deadline, so HTTP calls made through
+  DataverseHelper are bounded by it. A stuck call is abandoned: the caller gets
+  TimeoutError right away while the stuck thread gives up at its next check.
+
+  The abandoned thread cannot be stopped from outside. It keeps running func
+  until func next checks the deadline, through remaining() or check(), and
+  any call that does not check, e.g. into the dataverse library, runs to the
+  end. So func should call check() before each step with side effects.
+  Otherwise a timed-out task may still write them after the caller moved on.
+  '''
+  parent = current_deadline()
+  if parent is not None:
+    seconds = min(seconds, parent.remaining())
+  result = {}
+  def run():
+    with deadline(seconds):
+      try:
+        result['value'] = func()
+      except BaseException:
+        result['error'] = sys.exc_info()
+  worker = threading.Thread(target=run,
+      name='timeout-%s' % threading.current_thread().name)
+  worker.daemon = True
+  worker.start()
+  worker.join(seconds)
+  if worker.is_alive():
+    raise TimeoutError('Function timed out after %g seconds.' % seconds)
+  if 'error' in result:
+    exc_type, exc_value, tb = result['error']
+    raise exc_type, exc_value, tb
+  return result.get('value')
+
+
+def Test():
+  assert(timeout(lambda: 'done', 5) == 'done')
+  assert(remaining() is None)
   try:
-    result = func()
-  finally:
-    signal.alarm(0)
-  return result
+    timeout(lambda: time.sleep(5), 0.2)
+    assert(False)
+  except TimeoutError:
+    pass
+  try:
+    timeout(lambda: int('x'), 5)
+    assert(False)
+  except ValueError:
+    pass
+  seen = []
+  def nested():
+    seen.append(remaining())
+    return timeout(lambda: seen.append(remaining()), 60)
+  timeout(nested, 1)
+  assert(seen[0] <= 1 and seen[1] <= 1)
+  with deadline(0):
+    try:
+      remaining()
+      assert(False)
+    except TimeoutError:
+      pass
+  assert(current_deadline() is None)
+  check()
+  # An abandoned task stops at its next check instead of writing.
+  writes = []
+  def slow_write():
+    time.sleep(0.3)
+    check()
+    writes.append(1)
+  try:
+    timeout(slow_write, 0.1)
+    assert(False)
+  except TimeoutError:
+    pass
+  time.sleep(0.4)
+  assert(writes == [])
+  results = []
+  threads = [threading.Thread(target=lambda i=i: results.append(
+    timeout(lambda: i, 5))) for i in xrange(4)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+  assert(sorted(results) == range(4))
+  print 'Tests passed.'
+
+
+if __name__ == '__main__':
+  Test()
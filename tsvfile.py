@@ -26,59 +26,395 @@ This module defines several helper methods for working with tabular data in
 tab-delimited files.
 '''
 import os
+import sys
+import re
+import stat
 import collections
 import csv
-import itertools
+import operator
+import shutil
+import tempfile
+import threading
+import cPickle
 
 
-def ReadDicts(infile):
+def ReadDicts(infile, columns=None):
   '''ReadDicts
   
   Reads tab-delimited data from a file and returns a list of dicts for the rows.
 
-  See also: WriteDicts
+  See also: WriteDicts, IterDicts
 
   Params:
     infile: File path of the tab-delimited file to read.
+    columns: Optional list of columns to keep, see IterDicts.
 
   Returns:
     A list of dicts where each row is represented with one dict.
   '''
+  return list(IterDicts(infile, columns))
+
+def ReadHeader(infile):
+  '''ReadHeader
+
+  Reads the column names from the first line of a tab-delimited file.
+
+  Params:
+    infile: File path of the tab-delimited file to read.
+
+  Returns:
+    A list of the column names.
+  '''
   with open(infile, 'rbU') as fid:
-    reader = csv.DictReader(fid, delimiter='\t')
-    rows = list(reader)
-  return rows
+    return next(csv.reader(fid, delimiter='\t'), [])
+
+def _ColumnIndices(infile, header, columns):
+  missing = [x for x in columns if x not in header]
+  if missing:
+    raise ValueError('Missing columns in %s: %s' % (infile, ', '.join(missing)))
+  return [header.index(x) for x in columns]
+
+def IterTuples(infile, columns=None, named=False):
+  '''IterTuples
+
+  Reads tab-delimited data from a file, yielding one tuple per row.
+
+  Tuples hold the values in the order of columns, or of the header of the file
+  if columns is None (see ReadHeader). They are smaller and faster to build
+  than dicts, and all rows share the one list of column names. Short rows are
+  padded with None as csv.DictReader does.
+
+  With named=True the rows are namedtuples, with the column names turned into
+  identifiers by replacing other characters with "_", so the "Local ID" column
+  is the attribute Local_ID.
+
+  See also: IterDicts
+
+  Params:
+    infile: File path of the tab-delimited file to read.
+    columns: Optional list of the columns to read, default all.
+    named: Optional boolean, set True to yield namedtuples.
+
+  Returns:
+    A generator of tuples where each row is represented with one tuple.
+  '''
+  with open(infile, 'rbU') as fid:
+    reader = csv.reader(fid, delimiter='\t')
+    header = next(reader, None)
+    if header is None:
+      return
+    if columns is None:
+      columns = header
+      indices = range(len(header))
+    else:
+      indices = _ColumnIndices(infile, header, columns)
+    width = max(indices) + 1 if indices else 0
+    if named:
+      names = [re.sub(r'\W', '_', x) for x in columns]
+      make = collections.namedtuple('Row', names, rename=True)._make
+    else:
+      make = tuple
+    if indices == range(len(header)):
+      pick = None
+    elif not indices:
+      # itemgetter needs at least one index.
+      pick = lambda row: ()
+    elif len(indices) == 1:
+      index = indices[0]
+      pick = lambda row: (row[index],)
+    else:
+      pick = operator.itemgetter(*indices)
+    for row in reader:
+      if not row:
+        continue  # csv.DictReader skips blank lines too.
+      if len(row) < width:
+        row = row + [None]*(width - len(row))
+      yield make(row[:len(header)] if pick is None else pick(row))
+
+def IterDicts(infile, columns=None):
+  '''IterDicts
+
+  Reads tab-delimited data from a file, yielding one dict per row.
+
+  Unlike ReadDicts, only the current row is held in memory. With columns, each
+  dict only has those keys, which is much faster for a few columns of a wide
+  file.
+
+  See also: ReadDicts, IterTuples
+
+  Params:
+    infile: File path of the tab-delimited file to read.
+    columns: Optional list of columns to keep, default all. Raises ValueError
+      if the file lacks any of them.
+
+  Returns:
+    A generator of dicts where each row is represented with one dict.
+  '''
+  if columns is None:
+    with open(infile, 'rbU') as fid:
+      for row in csv.DictReader(fid, delimiter='\t'):
+        yield row
+    return
+  columns = list(columns)
+  for values in IterTuples(infile, columns):
+    yield dict(zip(columns, values))
+
+# Write buffer for WriteDicts, large enough that rows are written in big
+# chunks rather than one system call every few kilobytes.
+WRITE_BUFFER_SIZE = 1 << 20
+
+def MakeTempPath(outfile):
+  '''MakeTempPath
+
+  Creates an empty temp file next to outfile and returns its path.
 
-def WriteDicts(outfile, rows, tempfile=None):
+  Renaming the temp file over outfile is atomic. It gets the permissions of
+  outfile, or those of a new file if outfile does not exist, rather than the
+  owner-only permissions of tempfile.mkstemp.
+
+  Params:
+    outfile: Path of the file the temp file will replace.
+  '''
+  outdir = os.path.dirname(os.path.abspath(outfile))
+  handle, temp_path = tempfile.mkstemp(dir=outdir,
+      prefix='.%s.' % os.path.basename(outfile), suffix='.tmp')
+  os.close(handle)
+  if os.path.exists(outfile):
+    mode = stat.S_IMODE(os.stat(outfile).st_mode)
+  else:
+    # mkstemp creates files readable only by the owner, unlike open().
+    umask = os.umask(0)
+    os.umask(umask)
+    mode = 0666 & ~umask
+  os.chmod(temp_path, mode)
+  return temp_path
+
+def _SyncDir(dirpath):
+  # Makes a rename in dirpath durable. Not possible on all platforms.
+  try:
+    handle = os.open(dirpath, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    os.fsync(handle)
+  except OSError:
+    pass
+  finally:
+    os.close(handle)
+
+def _WriteFile(outfile, write, temp_path=None, atomic=True):
+  # Calls write with a file object for outfile. Unless atomic is False, the
+  # data goes to temp_path or a new temp file, which is synced to disk and
+  # renamed over outfile, so outfile is never left partly written.
+  if temp_path is not None:
+    writeout = temp_path
+  elif atomic:
+    writeout = MakeTempPath(outfile)
+  else:
+    writeout = outfile
+  try:
+    with open(writeout, 'wb', WRITE_BUFFER_SIZE) as fid:
+      write(fid)
+      if writeout != outfile:
+        fid.flush()
+        os.fsync(fid.fileno())
+    if writeout != outfile:
+      os.rename(writeout, outfile)
+      _SyncDir(os.path.dirname(os.path.abspath(outfile)))
+  except:
+    if writeout != outfile and os.path.exists(writeout):
+      os.remove(writeout)
+    raise
+
+def WriteDicts(outfile, rows, tempfile=None, atomic=True):
   '''WriteDicts
 
   Writes tabular data in a list of dicts to a tab-delimited file.
 
   See also: ReadDicts
 
-  If tempfile is None, interrupting this method while writing can cause
-  corrupted data in the file specified by outfile. Specify tempfile to use
-  atomic rewrites.
+  By default the rows are written to a temp file in the same directory, which
+  is synced to disk and renamed over outfile, so outfile always holds either
+  the old or the new data even if this method is interrupted. The file keeps
+  the permissions of the file it replaces.
 
   Params:
     outfile: Path of the output tab-delimited file to write.
     rows: The input data to write out, as a list of dicts.
-    tempfile: Optional path to a temp file to provide atomic rewrite.
+    tempfile: Optional path of the temp file to use for the atomic rewrite.
+    atomic: Optional boolean, set False to write outfile in place, which can
+      leave it corrupted if interrupted. Ignored if tempfile is given.
   '''
-  header = sorted(list(set(itertools.chain(*[x.keys() for x in rows]))))
-  if tempfile is not None:
-    writeout = tempfile
-  else:
-    writeout = outfile
-  with open(writeout, 'wb') as fid:
+  header = set()
+  for row in rows:
+    header.update(row.iterkeys())
+  header = sorted(header)
+  def WriteRows(fid):
     writer = csv.DictWriter(fid, header, delimiter='\t')
     writer.writeheader()
-    for row in rows:
-      writer.writerow(row)
-  if tempfile is not None:
-    os.rename(tempfile, outfile)
+    writer.writerows(rows)
+  _WriteFile(outfile, WriteRows, tempfile, atomic)
   print 'Wrote %d rows to file: %s' % (len(rows), outfile)
   
+class SpooledDictWriter(object):
+  '''SpooledDictWriter
+
+  Writes dicts one at a time to a tab-delimited file whose header is the union
+  of all their keys, as with WriteDicts.
+
+  The header is only known once every row has been seen, so rows are spooled
+  to an anonymous temp file and the output is written by Close, atomically as
+  in WriteDicts.
+
+  See also: WriteDicts
+  '''
+
+  def __init__(self, outfile):
+    self.outfile = outfile
+    self.header = set()
+    self.num_rows = 0
+    self.spool = tempfile.TemporaryFile()
+
+  def Write(self, row):
+    self.header.update(row.iterkeys())
+    cPickle.dump(row, self.spool, cPickle.HIGHEST_PROTOCOL)
+    self.num_rows += 1
+
+  def Close(self):
+    def WriteRows(fid):
+      writer = csv.DictWriter(fid, sorted(self.header), delimiter='\t')
+      writer.writeheader()
+      for unused_i in xrange(self.num_rows):
+        writer.writerow(cPickle.load(self.spool))
+    self.spool.seek(0)
+    try:
+      _WriteFile(self.outfile, WriteRows)
+    finally:
+      self.spool.close()
+    print 'Wrote %d rows to file: %s' % (self.num_rows, self.outfile)
+
+class TsvAppender(object):
+  '''TsvAppender
+
+  Appends dicts one at a time to a tab-delimited file with a fixed header.
+
+  Each Write adds a single line, where WriteDicts rewrites the whole file.
+  An existing file is appended to if its header has the same columns. If the
+  process was killed while writing, the partial last line is dropped when the
+  file is opened again, so values must not contain line breaks. A last row
+  that has all its fields but no line break is kept.
+
+  See also: WriteDicts
+  '''
+
+  def __init__(self, outfile, header, fsync_every=1, lazy=False):
+    '''__init__
+
+    Params:
+      outfile: Path of the tab-delimited file to append to or create.
+      header: List of the columns.
+      fsync_every: Optional number of rows between syncs to disk, default 1.
+        Rows are always flushed to the OS right away. Use 0 to never sync.
+      lazy: Optional boolean, open outfile on the first Write instead of
+        now, so no file is created if nothing is written.
+    '''
+    self.outfile = outfile
+    self.fsync_every = fsync_every
+    self.lock = threading.Lock()
+    self.num_rows = 0
+    self.fid = None
+    if not lazy:
+      self._Open(header)
+    else:
+      self.header = list(header)
+
+  def _Open(self, header):
+    outfile = self.outfile
+    header = list(header)
+    existing = self._Recover(header)
+    self.fid = open(outfile, 'ab')
+    if existing is None:
+      self.header = header
+      csv.writer(self.fid, delimiter='\t').writerow(header)
+      self._Sync(True)
+    elif sorted(existing) != sorted(header):
+      self.fid.close()
+      raise ValueError('Header of %s is %s, expected %s' % (outfile,
+        existing, header))
+    else:
+      self.header = existing
+    self.writer = csv.DictWriter(self.fid, self.header, delimiter='\t')
+
+  def _Recover(self, header):
+    # Finishes the last line and returns the existing header, if any. A last
+    # line without a line break is kept if it has as many fields as the
+    # header, as in a file saved by an editor, and dropped otherwise.
+    if not os.path.isfile(self.outfile):
+      return None
+    with open(self.outfile, 'r+b') as fid:
+      fid.seek(0, os.SEEK_END)
+      size = fid.tell()
+      # Only the end of the file needs to be read to find the last newline.
+      tail_start = max(0, size - 65536)
+      fid.seek(tail_start)
+      tail = fid.read()
+      while tail_start > 0 and '\n' not in tail:
+        tail_start = max(0, tail_start - 65536)
+        fid.seek(tail_start)
+        tail = fid.read()
+      newline = tail.rfind('\n')
+      complete_len = tail_start + newline + 1
+      if complete_len < size:
+        try:
+          last = next(csv.reader([tail[newline + 1:]], delimiter='\t'))
+        except csv.Error:
+          last = []
+        if complete_len == 0:
+          # The header itself is the unfinished line.
+          complete = sorted(last) == sorted(header)
+        else:
+          fid.seek(0)
+          complete = len(last) >= len(next(csv.reader(fid, delimiter='\t')))
+        if complete:
+          # Match the line break of the previous line, or that of csv.writer.
+          fid.seek(0, os.SEEK_END)
+          if newline > 0 and tail[newline - 1] != '\r':
+            fid.write('\n')
+          else:
+            fid.write('\r\n')
+        else:
+          print 'Dropping partial last line of file: %s' % self.outfile
+          fid.truncate(complete_len)
+      fid.seek(0)
+      existing = next(csv.reader(fid, delimiter='\t'), None)
+    return existing
+
+  def _Sync(self, force=False):
+    self.fid.flush()
+    if force or (self.fsync_every and self.num_rows % self.fsync_every == 0):
+      os.fsync(self.fid.fileno())
+
+  def Write(self, row):
+    '''Write
+
+    Appends one row.
+
+    Params:
+      row: Dict of the row, with keys from the header.
+    '''
+    with self.lock:
+      if self.fid is None:
+        self._Open(self.header)
+      self.writer.writerow(row)
+      self.num_rows += 1
+      self._Sync()
+
+  def Close(self):
+    with self.lock:
+      if self.fid is not None and not self.fid.closed:
+        self._Sync(self.fsync_every != 0)
+        self.fid.close()
+
 def ReadOrInit(iofile):
   '''ReadOrInit
 
@@ -152,3 +488,111 @@ def GroupByUnique(rows, fields):
     A dict mapping the values in column "fields" to the rows with that value.
   '''
   return GroupBy(rows, fields, True)
+
+
+def Test():
+  testdir = tempfile.mkdtemp()
+  try:
+    outfile = os.path.join(testdir, 'test.tsv')
+    rows = [{'Local ID':'a', 'DOI':'d1'}, {'Local ID':'b', 'Extra':'x'}]
+    WriteDicts(outfile, rows)
+    os.chmod(outfile, 0640)
+    WriteDicts(outfile, rows + [{'DOI':'d3'}])
+    assert(stat.S_IMODE(os.stat(outfile).st_mode) == 0640)
+    assert(os.listdir(testdir) == ['test.tsv'])
+    assert(ReadHeader(outfile) == ['DOI', 'Extra', 'Local ID'])
+    assert(ReadDicts(outfile, ['Local ID'])[:2] == [{'Local ID':'a'},
+      {'Local ID':'b'}])
+    assert(list(IterTuples(outfile, ['DOI', 'Local ID'])) == [('d1', 'a'),
+      ('', 'b'), ('d3', '')])
+    assert(list(IterTuples(outfile, [])) == [(), (), ()])
+    assert(ReadDicts(outfile, []) == [{}, {}, {}])
+    # A failed write leaves the old file and no temp file behind.
+    class Unwritable(object):
+      def __str__(self):
+        raise RuntimeError('Cannot write')
+    try:
+      WriteDicts(outfile, [{'DOI':'d4'}, {'DOI':Unwritable()}])
+      assert(False)
+    except RuntimeError:
+      pass
+    assert(len(ReadDicts(outfile)) == 3 and len(os.listdir(testdir)) == 1)
+    spooledfile = os.path.join(testdir, 'spooled.tsv')
+    WriteDicts(spooledfile, rows)
+    os.chmod(spooledfile, 0640)
+    writer = SpooledDictWriter(spooledfile)
+    for row in rows + [{'DOI':'d3'}]:
+      writer.Write(row)
+    writer.Close()
+    assert(ReadDicts(spooledfile) == ReadDicts(outfile))
+    assert(stat.S_IMODE(os.stat(spooledfile).st_mode) == 0640)
+    os.remove(spooledfile)
+    assert(os.listdir(testdir) == ['test.tsv'])
+    # An interrupted append is dropped when the file is opened again.
+    appender = TsvAppender(outfile, ['Local ID', 'Extra', 'DOI'])
+    appender.Write({'Local ID':'c'})
+    appender.Close()
+    with open(outfile, 'ab') as fid:
+      fid.write('d5\t')
+    TsvAppender(outfile, ['DOI', 'Extra', 'Local ID']).Close()
+    assert([x['Local ID'] for x in ReadDicts(outfile)] == ['a', 'b', '', 'c'])
+    # A complete last row without a line break is kept, a partial one is not.
+    editedfile = os.path.join(testdir, 'edited.tsv')
+    with open(editedfile, 'wb') as fid:
+      fid.write('DOI\tLocal ID\r\ndoi:1\tA\r\ndoi:2\tB')
+    appender = TsvAppender(editedfile, ['DOI', 'Local ID'])
+    appender.Write({'DOI':'doi:3', 'Local ID':'C'})
+    appender.Close()
+    assert([x['DOI'] for x in ReadDicts(editedfile)] == ['doi:1', 'doi:2',
+      'doi:3'])
+    with open(editedfile, 'ab') as fid:
+      fid.write('doi:4')
+    appender = TsvAppender(editedfile, ['DOI', 'Local ID'])
+    appender.Write({'DOI':'doi:5', 'Local ID':'E'})
+    appender.Close()
+    assert([x['DOI'] for x in ReadDicts(editedfile)] == ['doi:1', 'doi:2',
+      'doi:3', 'doi:5'])
+    lazyfile = os.path.join(testdir, 'lazy.tsv')
+    TsvAppender(lazyfile, ['DOI'], lazy=True).Close()
+    assert(not os.path.exists(lazyfile))
+    appender = TsvAppender(lazyfile, ['DOI'], lazy=True)
+    appender.Write({'DOI':'d6'})
+    appender.Close()
+    assert(ReadDicts(lazyfile) == [{'DOI':'d6'}])
+  finally:
+    shutil.rmtree(testdir)
+  print 'Tests passed.'
+
+
+def BenchmarkWriteDicts(num_rows=100000):
+  '''BenchmarkWriteDicts
+
+  Times WriteDicts on a synthetic DOI map, printing results to stdout.
+
+  The atomic default is compared with writing the file in place.
+  '''
+  import timeit
+  rows = [{'Local ID':'PDS%08d|Subject of petition %d|Boston|Signer' % (i, i),
+    'DOI':'doi:10.7910/DVN/%06X' % i} for i in xrange(num_rows)]
+  testdir = tempfile.mkdtemp()
+  outfile = os.path.join(testdir, 'benchmark.tsv')
+  try:
+    def InPlace():
+      WriteDicts(outfile, rows, atomic=False)
+    def Atomic():
+      WriteDicts(outfile, rows)
+    in_place = min(timeit.repeat(InPlace, number=1, repeat=3))
+    atomic = min(timeit.repeat(Atomic, number=1, repeat=3))
+    size = os.path.getsize(outfile)
+  finally:
+    shutil.rmtree(testdir)
+  print 'WriteDicts of %d rows (%.1f MB):' % (num_rows, size / 1e6)
+  print '  in place: %.3f s (%.1f MB/s)' % (in_place, size / 1e6 / in_place)
+  print '  atomic:   %.3f s (%.1f MB/s)' % (atomic, size / 1e6 / atomic)
+
+
+if __name__ == '__main__':
+  if '--benchmark' in sys.argv[1:]:
+    BenchmarkWriteDicts()
+  else:
+    Test()
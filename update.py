@@ -26,13 +26,16 @@ February 23 2018
 
 import sys
 import json
+import copy
 import re
 import os
 import time
-import copy
+import hashlib
 import collections
 import traceback
 import optparse
+import threading
+import Queue
 from datetime import datetime
 
 import dataverse
@@ -43,7 +46,10 @@ import jsonformatter
 import tsvfile
 import jsonutils
 import timeout
+import jsonjournal
 import petitiondoiresolver
+import pipeline
+import mappingstore
 
 
 parser = optparse.OptionParser()
@@ -58,6 +64,29 @@ parser.add_option('--doi_updates_output_tsv',
     help='Output tsv file to write updates to DOI mapping')
 parser.add_option('--dataverse_name',
     help='Name of the already-present Dataverse to populate Studies into.')
+parser.add_option('--prefetch_entity_ids', action='store_true', default=False,
+    help='Fill the entity ID cache from a paged search of the Dataverse.')
+parser.add_option('--workers', type='int', default=1,
+    help='Number of rows to update concurrently (default 1, serial).')
+parser.add_option('--pipeline', action='store_true', default=False,
+    help='Run the stages of the update (resolve, fetch, diff, upload, '
+    'publish) concurrently for different rows, each with --workers threads.')
+parser.add_option('--stage_workers', default='',
+    help='With --pipeline, threads per stage overriding --workers, e.g. '
+    '"fetch=4,upload=2".')
+parser.add_option('--state_file', default='update_state.json',
+    help='Local record of what was last published for each DOI, used to '
+    'skip unchanged rows without contacting the server.')
+parser.add_option('--debug_json_file', default=None,
+    help='Write the local metadata of the latest row to this file, e.g. '
+    'tmp_update_last_metadata.json.')
+parser.add_option('--mapping_db', default=None,
+    help='SQLite mapping store (see mappingstore.py) to look up DOIs and '
+    'entity IDs in and to record new ones to. --doi_tsv, if given, is '
+    'imported into it first.')
+parser.add_option('--force_verify', action='store_true', default=False,
+    help='Check every row against the server even if --state_file says it '
+    'is unchanged.')
 options, unused_args = parser.parse_args()
 api_key = options.api_key
 doi_tsv = options.doi_tsv
@@ -65,6 +94,13 @@ infile = options.input_tsv
 study_data_filepath = options.attachment_file
 doi_update_tsv = options.doi_updates_output_tsv
 dataverse_name = options.dataverse_name
+num_workers = options.workers
+force_verify = options.force_verify
+if num_workers < 1:
+  raise ValueError('--workers must be at least 1, got %d' % num_workers)
+if options.prefetch_entity_ids and not dataverse_name:
+  parser.error('--prefetch_entity_ids needs --dataverse_name, or it would '
+      'search all of the server.')
 
 # Use these for test/dev keys.
 dv_test_api_key = ''
@@ -83,25 +119,70 @@ if not os.path.isfile(study_data_filepath):
   raise ValueError('Study data filepath not found: %s' % study_data_filepath)
 
 dvid_cache_file = 'dataverse_entity_ids.json'
-debug_json_file = 'tmp_update_last_metadata.json'
+debug_json_file = options.debug_json_file
+state_file = options.state_file
+
+mapping_store = None
+if options.mapping_db:
+  mapping_store = mappingstore.MappingStore(options.mapping_db)
 
 if not USE_NON_PROD_SERVER:
   # Production
   dataverse_conn = dataverse.Connection('dataverse.harvard.edu', api_key)
   dataverse_obj = dataverse_conn.get_dataverse(dataverse_name)
   dvhelper = dataversehelper.DataverseHelper(api_key, dataverse_obj,
-      dvid_cache_file)
+      dvid_cache_file, pool_maxsize=max(10, num_workers),
+      mapping_store=mapping_store)
 else:
   # Beta server
   dataverse_conn = dataverse.Connection('beta.dataverse.org', dv_beta_api_key)
   #dataverse_conn = dataverse.Connection('apitest.dataverse.org', dv_test_api_key)
   dataverse_obj = dataverse_conn.get_dataverse(dataverse_name)
   dvhelper = dataversehelper.DataverseHelper(dv_beta_api_key, dataverse_obj,
-      None, 'beta.dataverse.org')
+      None, 'beta.dataverse.org', pool_maxsize=max(10, num_workers),
+      mapping_store=mapping_store)
+
+if options.prefetch_entity_ids:
+  dvhelper.prefetch_entity_ids()
+
+
+# Per DOI, hashes of the metadata and attachment file last seen published.
+update_state = jsonjournal.JsonJournal(state_file)
+
+def hash_metadata(row):
+  # Hashes the metadata generated for the row rather than the row itself, so
+  # a change to jsonformatter is caught too. It is generated without the
+  # published metadata, which is not fetched yet, and without the
+  # dateOfDeposit field, which is always today's date.
+  metadata_blocks = jsonformatter.FormatToJson.setrow(row, {})['metadataBlocks']
+  for block in metadata_blocks.itervalues():
+    block['fields'] = [x for x in block['fields']
+        if x.get('typeName') != 'dateOfDeposit']
+  return hashlib.sha1(json.dumps(metadata_blocks, sort_keys=True)).hexdigest()
+
+def hash_file(filepath):
+  sha1 = hashlib.sha1()
+  with open(filepath, 'rb') as fid:
+    for chunk in iter(lambda: fid.read(1 << 20), ''):
+      sha1.update(chunk)
+  return sha1.hexdigest()
+
+attachment_hash = hash_file(study_data_filepath)
+
 
+doi_lookup = {}
+if mapping_store is None:
+  doi_lookup = dict(tsvfile.IterTuples(doi_tsv, ['Local ID', 'DOI']))
+elif doi_tsv:
+  unused_counters, conflicts = mapping_store.import_tsv(doi_tsv)
+  for unused_i, local_id, doi, conflict, existing in conflicts:
+    print 'WARNING: %s not imported, %s already mapped to %s' % (
+        doi, conflict, existing)
 
-doi_lookup = dict([(x['Local ID'], x['DOI']) for x in 
-  tsvfile.ReadDicts(doi_tsv)])
+def lookup_doi(local_id):
+  if mapping_store is not None:
+    return mapping_store.get_doi(local_id)
+  return doi_lookup.get(local_id)
 
 rows = tsvfile.ReadDicts(infile)
 
@@ -116,6 +197,14 @@ if len(debug_local_ids) > 0:
       len(debug_local_ids))
 
 
+# Shared state below is updated from several threads when --workers > 1.
+counters_lock = threading.Lock()
+debug_json_lock = threading.Lock()
+
+def increment(counters, key):
+  with counters_lock:
+    counters[key] += 1
+
 def coerce_utf8(data):
   if type(data) is unicode: return data
   return unicode(data.decode('utf8'))
@@ -145,12 +234,14 @@ def avoid_update_on_dates(published_metadata, local_metadata):
       citation_date_indices.items()]
   citation_date_rewrites.sort(key=lambda x: 
       (2, -1*x[1]) if x[2] is None else (1,1))
+  # The published fields are copied, since copy_update_base shares them with
+  # published_metadata and local_metadata may be edited later.
   for field, old, new in citation_date_rewrites:
     old_path = '%s/%d/value' % (citation_path, old)
     if new is None:
       jsonutils.jpath(local_metadata, citation_path).insert(
-          old, jsonutils.jpath(published_metadata, 
-            '%s/%d' % (citation_path, old)))
+          old, copy.deepcopy(jsonutils.jpath(published_metadata, 
+            '%s/%d' % (citation_path, old))))
       new_path = '%s/%d/value' % (citation_path, old)
       print 'Avoid update on date: inserted %s:"%s"' % (
           new_path, jsonutils.jpath(local_metadata, new_path))
@@ -160,25 +251,40 @@ def avoid_update_on_dates(published_metadata, local_metadata):
           new_path, jsonutils.jpath(local_metadata, new_path),
           old_path, jsonutils.jpath(published_metadata, old_path))
       jsonutils.jpath(local_metadata, new_path,
-          jsonutils.jpath(published_metadata, old_path))
+          copy.deepcopy(jsonutils.jpath(published_metadata, old_path)))
 
-def update(row, commit=True, show_diff=True,
-    counters=collections.defaultdict(int), doi_update_rows=[],
-    force_update_file=False):
-  global doi_lookup
+def copy_update_base(published_metadata):
+  # FormatToJson.setrow only assigns new values at the top level and in the
+  # metadata block dicts, so copying those levels keeps published_metadata
+  # intact without a deep copy. The rest of the tree is shared.
+  update_base = dict(published_metadata)
+  if 'metadataBlocks' in update_base:
+    update_base['metadataBlocks'] = dict((k, dict(v)) for k, v in
+        update_base['metadataBlocks'].iteritems())
+  return update_base
+
+# The update of one row runs as the stages below, each taking and returning a
+# task dict, or returning None when the row needs no further stages. update()
+# runs them back to back, --pipeline runs them in a pipeline.StagedPipeline.
+
+def resolve_stage(task):
+  row = task['row']
+  counters = task['counters']
+  commit = task['commit']
   local_id = row['Local ID']
-  doi = None
   dataset = None
-  if local_id in doi_lookup:
+  doi = lookup_doi(local_id)
+  cached = doi is not None
+  if cached:
     print 'DOI cache hit for local ID: %s' % local_id
-    doi = doi_lookup[local_id]
   else:
     print 'DOI cache miss for local ID: %s' % local_id
     doi = petitiondoiresolver.resolve(dvhelper, row)
     if not doi:
       print 'No DOI found for local ID: %s' % local_id
       print 'Attempting to create new study...'
-      counters['create'] += 1
+      timeout.check()
+      increment(counters, 'create')
       if commit:
         dataset = dvhelper.create_and_publish_new_study(row['Title'],
             coerce_utf8(row['Description']))
@@ -195,29 +301,61 @@ def update(row, commit=True, show_diff=True,
         print 'Newly created DOI %s for ID %s' % (doi, local_id)
       else:
         print 'Not committing changes, no dataset creation, aborting.'
-        return doi
+        return None
+  task['doi'] = doi
+  task['dataset'] = dataset
   print 'Resolved %s -> %s' % (local_id, doi)
-  if local_id not in doi_lookup:
-    print 'Writing new DOI %s for local ID: %s' % (doi, local_id)
-    doi_update_rows.append({'Local ID':row['Local ID'], 'DOI':doi})
-    tsvfile.WriteDicts(doi_update_tsv, doi_update_rows)
+  timeout.check()
+  if not cached:
+    if task['doi_updates'] is not None:
+      print 'Writing new DOI %s for local ID: %s' % (doi, local_id)
+      task['doi_updates'].Write({'Local ID':row['Local ID'], 'DOI':doi})
+    else:
+      print 'New DOI %s for local ID %s, no --doi_updates_output_tsv' % (
+          doi, local_id)
+    if mapping_store is not None:
+      mapping_store.add_mapping(local_id, doi)
+  state = {'metadata':hash_metadata(row), 'file':attachment_hash}
+  task['state'] = state
+  if (not force_verify and not task['force_update_file'] and
+      dataset is None and update_state.get(doi) == state):
+    print '%s | Unchanged since last published, skipping.' % doi
+    increment(counters, 'skipped')
+    return None
+  return task
+
+def fetch_stage(task):
+  doi = task['doi']
   print '%s | Beginning incremental update %s at %s' % (doi,
-      ('committing changes' if commit else 'preview'), datetime.utcnow())
+      ('committing changes' if task['commit'] else 'preview'),
+      datetime.utcnow())
   #published_metadata = study_obj.get_metadata('latest-published')
-  published_metadata = dvhelper.get_study_metadata(doi, 'latest-published')
+  task['published_metadata'] = dvhelper.get_study_metadata(doi,
+      'latest-published')
   print '%s | Loaded study metadata.' % doi
+  return task
+
+def diff_stage(task):
+  doi = task['doi']
+  row = task['row']
+  counters = task['counters']
+  show_diff = task['show_diff']
+  force_update_file = task['force_update_file']
+  published_metadata = task['published_metadata']
   # Make a local copy of metadata.
-  update_base = copy.deepcopy(published_metadata)
+  update_base = copy_update_base(published_metadata)
   # Remove database state fields.
   jsonutils.jpath_delete(update_base, 'lastUpdateTime')
   jsonutils.jpath_delete(update_base, 'createTime')
   jsonutils.jpath_delete(update_base, 'distributionDate')
   jsonutils.jpath_delete(update_base, 'files')
-  local_metadata = json.loads(json.dumps(
-    jsonformatter.FormatToJson.setrow(row, update_base)))
-  with open(debug_json_file, 'wb') as fid:
-    fid.write(json.dumps(local_metadata, sort_keys=True, indent=2))
-  print '%s | Wrote local metadata to: %s' % (doi, debug_json_file)
+  local_metadata = jsonformatter.FormatToJson.setrow(row, update_base)
+  task['local_metadata'] = local_metadata
+  if debug_json_file:
+    with debug_json_lock:
+      with open(debug_json_file, 'wb') as fid:
+        fid.write(json.dumps(local_metadata, sort_keys=True, indent=2))
+    print '%s | Wrote local metadata to: %s' % (doi, debug_json_file)
   if not force_update_file:
     # Keep same citation dates for diff
     avoid_update_on_dates(published_metadata, local_metadata)
@@ -225,85 +363,221 @@ def update(row, commit=True, show_diff=True,
   unchanged = jsonutils.jsondiff(published_metadata['metadataBlocks'],
       local_metadata['metadataBlocks'], verbose=show_diff)
   if show_diff: print '%s | Diff end' % doi
+  timeout.check()
   has_file = len(published_metadata['files']) > 0
-  if not force_update_file and unchanged and has_file:
+  # A different attachment than the one recorded as published is uploaded
+  # again even when the metadata is unchanged.
+  previous_state = update_state.get(doi)
+  file_changed = (previous_state is not None and
+      previous_state['file'] != attachment_hash)
+  if file_changed: print '%s | Attachment file changed.' % doi
+  if not force_update_file and not file_changed and unchanged and has_file:
     print '%s | No update required.' % doi
-    counters['unchanged'] += 1
+    increment(counters, 'unchanged')
+    update_state.set(doi, task['state'])
+    return None
+  print '%s | Updating...' % doi
+  increment(counters, 'update')
+  if not task['commit']:
+    print '%s | Preview only, no changes.' % doi
+    return None
+  return task
+
+def upload_stage(task):
+  doi = task['doi']
+  local_metadata = task['local_metadata']
+  if task['dataset'] is not None:
+    print '%s | Using newly-created study object...' % doi
+    study_obj = task['dataset']
   else:
-    print '%s | Updating...' % doi
-    counters['update'] += 1
-    if commit:
-      if dataset is not None:
-        print '%s | Using newly-created study object...' % doi
-        study_obj = dataset
-      else:
-        print '%s | Loading study object...' % doi
-        #study_obj = dataverse_obj.get_dataset_by_doi(doi)  # Now fails
-        study_obj = dataverse.Dataset(
-            dataverse=dataverse_obj, 
-            edit_media_uri=dvhelper.get_edit_media_uri(doi),
-            edit_uri=dvhelper.get_edit_uri(doi),
-            title='title')
-      if study_obj is None:
-        raise RuntimeError('Failed to load Dataset object for DOI: %s' % doi)
-      print '%s | Loading dataverse entity ID...' % doi
-      study_obj._id = dvhelper.get_entity_id(doi)  # Fix never-ending lookup.
-      print '%s | Created study object' % doi
-      study_obj.update_metadata(local_metadata)
-      print '%s | Put new metadata.' % doi
-      result = study_obj.get_metadata(refresh=False)
-      if not jsonutils.jsondiff(local_metadata['metadataBlocks'], 
-          result['metadataBlocks']):
-        raise RuntimeError('Updated metadata differs from local.')
-      print '%s | Uploading filepath: %s' % (doi, study_data_filepath)
-      for prev_file in study_obj.get_files(refresh=False):
-        print '%s | Delete file: %s %s' % (doi, prev_file.id, prev_file.name)
-        study_obj.delete_file(prev_file)
-      dataset = dataversewrapper.WrapDataset(dataverse_obj, doi,
-          dvhelper.get_entity_id(doi))
-      dataset.upload_filepath(study_data_filepath)
-      #dvhelper.upload_file(doi, study_data_filepath)
-      time.sleep(5)  # Sleep because ingestion can create a race condition.
-      print '%s | Upload finished.' % doi
-      dvhelper.publish_study(doi)
-      print '%s | Published' % doi
-      print '%s | Update finished at %s.' % (doi, datetime.utcnow())
-    else:
-      print '%s | Preview only, no changes.' % doi
-  return doi
+    print '%s | Loading study object...' % doi
+    #study_obj = dataverse_obj.get_dataset_by_doi(doi)  # Now fails
+    study_obj = dataverse.Dataset(
+        dataverse=dataverse_obj, 
+        edit_media_uri=dvhelper.get_edit_media_uri(doi),
+        edit_uri=dvhelper.get_edit_uri(doi),
+        title='title')
+  if study_obj is None:
+    raise RuntimeError('Failed to load Dataset object for DOI: %s' % doi)
+  print '%s | Loading dataverse entity ID...' % doi
+  study_obj._id = dvhelper.get_entity_id(doi)  # Fix never-ending lookup.
+  print '%s | Created study object' % doi
+  # The metadata goes through the pooled session of dvhelper. Listing,
+  # deleting and uploading files still use the dataverse library, which opens
+  # its own connections and does not check the deadline, so check it between
+  # these calls to keep an abandoned task from writing to the study.
+  timeout.check()
+  result = dvhelper.update_study_metadata(doi, local_metadata)
+  print '%s | Put new metadata.' % doi
+  if not jsonutils.jsondiff(local_metadata['metadataBlocks'], 
+      result['metadataBlocks']):
+    raise RuntimeError('Updated metadata differs from local.')
+  print '%s | Uploading filepath: %s' % (doi, study_data_filepath)
+  for prev_file in study_obj.get_files(refresh=False):
+    print '%s | Delete file: %s %s' % (doi, prev_file.id, prev_file.name)
+    timeout.check()
+    study_obj.delete_file(prev_file)
+  dataset = dataversewrapper.WrapDataset(dataverse_obj, doi,
+      dvhelper.get_entity_id(doi))
+  timeout.check()
+  dataset.upload_filepath(study_data_filepath)
+  #dvhelper.upload_file(doi, study_data_filepath)
+  time.sleep(5)  # Sleep because ingestion can create a race condition.
+  timeout.check()
+  print '%s | Upload finished.' % doi
+  return task
 
-ctr = 0
-counters = collections.defaultdict(int)
-doi_update_rows = []
-for row in rows:
-  ctr += 1
+def publish_stage(task):
+  doi = task['doi']
+  timeout.check()
+  dvhelper.publish_study(doi)
+  print '%s | Published' % doi
+  timeout.check()
+  update_state.set(doi, task['state'])
+  print '%s | Update finished at %s.' % (doi, datetime.utcnow())
+  return None
+
+UPDATE_STAGES = [
+    ('resolve', resolve_stage),
+    ('fetch', fetch_stage),
+    ('diff', diff_stage),
+    ('upload', upload_stage),
+    ('publish', publish_stage),
+    ]
+
+def new_task(ctr, row, commit=True, show_diff=True,
+    counters=collections.defaultdict(int), doi_updates=None,
+    force_update_file=False):
+  return {'ctr':ctr, 'row':row, 'doi':None, 'commit':commit,
+      'show_diff':show_diff, 'counters':counters,
+      'doi_updates':doi_updates,
+      'force_update_file':force_update_file}
+
+def update(row, commit=True, show_diff=True,
+    counters=collections.defaultdict(int), doi_updates=None,
+    force_update_file=False):
+  task = new_task(None, row, commit, show_diff, counters, doi_updates,
+      force_update_file)
+  for unused_name, stage in UPDATE_STAGES:
+    if stage(task) is None:
+      break
+  return task['doi']
+
+def process_row(ctr, row):
   local_id = row['Local ID']
   print '%s Processing %d/%d: %s' % (datetime.utcnow(), ctr, len(rows), 
       local_id)
-  counters['total'] += 1
+  increment(counters, 'total')
   last_fail_timeout = False
   def f():
     doi = update(row, commit=commit, show_diff=show_diff, 
-        counters=counters, doi_update_rows=doi_update_rows, 
+        counters=counters, doi_updates=doi_updates, 
         force_update_file=force_update_file)
   try:
     if last_fail_timeout:
       print 'Previous attempt timed out, waiting 30 seconds...'
       time.sleep(30)
     timeout.timeout(f, 180)
-    counters['success'] += 1
+    increment(counters, 'success')
     last_fail_timeout = False
   except KeyboardInterrupt: raise KeyboardInterrupt
   except SystemExit: raise SystemExit
   except Exception, e:
     print 'ERROR on row %d: %s' % (ctr, traceback.format_exc())
     if type(e) is timeout.TimeoutError:
-      counters['timeout'] += 1
+      increment(counters, 'timeout')
       last_fail_timeout = True
     else:
-      counters['error'] += 1
-  print str(dict(counters))
-print 'Consider running `python merge_doi_maps.py %s %s`' % (
-    doi_tsv, doi_update_tsv)
+      increment(counters, 'error')
+  with counters_lock:
+    print str(dict(counters))
 
+def parse_stage_workers(spec, default):
+  workers = dict((name, default) for name, unused_stage in UPDATE_STAGES)
+  for part in filter(None, spec.split(',')):
+    name, value = part.split('=')
+    if name not in workers:
+      raise ValueError('Unknown stage in --stage_workers: %s' % name)
+    workers[name] = int(value)
+  return workers
 
+def run_pipeline(rows, stage_workers):
+  def with_timeout(func):
+    return lambda task: timeout.timeout(lambda: func(task), 180)
+  def on_done(stage, task):
+    increment(counters, 'success')
+    with counters_lock:
+      print str(dict(counters))
+  def on_error(stage, task, e):
+    print 'ERROR on row %d in stage %s: %s' % (task['ctr'], stage.name,
+        traceback.format_exc())
+    if type(e) is timeout.TimeoutError:
+      increment(counters, 'timeout')
+    else:
+      increment(counters, 'error')
+    with counters_lock:
+      print str(dict(counters))
+  def tasks():
+    for ctr, row in enumerate(rows, 1):
+      print '%s Processing %d/%d: %s' % (datetime.utcnow(), ctr, len(rows),
+          row['Local ID'])
+      increment(counters, 'total')
+      yield new_task(ctr, row, commit=commit, show_diff=show_diff,
+          counters=counters, doi_updates=doi_updates,
+          force_update_file=force_update_file)
+  pipe = pipeline.StagedPipeline(
+      [pipeline.Stage(name, with_timeout(stage), stage_workers[name])
+        for name, stage in UPDATE_STAGES],
+      on_error=on_error, on_done=on_done)
+  pipe.run(tasks())
+  print pipe.report()
+
+def run_workers(rows, num_workers):
+  row_queue = Queue.Queue()
+  for ctr, row in enumerate(rows, 1):
+    row_queue.put((ctr, row))
+  def worker():
+    while True:
+      try:
+        ctr, row = row_queue.get_nowait()
+      except Queue.Empty:
+        return
+      process_row(ctr, row)
+  threads = [threading.Thread(target=worker, name='update-worker-%d' % i)
+      for i in xrange(num_workers)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  # Join with a timeout so KeyboardInterrupt still reaches the main thread.
+  while any(t.is_alive() for t in threads):
+    for t in threads:
+      t.join(1)
+
+counters = collections.defaultdict(int)
+# New DOIs are appended as they are found, keeping those of earlier runs.
+# The file is only created once there is a new DOI to write to it.
+doi_updates = None
+if doi_update_tsv:
+  doi_updates = tsvfile.TsvAppender(doi_update_tsv, ['DOI', 'Local ID'],
+      lazy=True)
+if options.pipeline:
+  stage_workers = parse_stage_workers(options.stage_workers, num_workers)
+  print 'Running update as a pipeline with workers per stage: %s' % (
+      stage_workers)
+  run_pipeline(rows, stage_workers)
+elif num_workers == 1:
+  ctr = 0
+  for row in rows:
+    ctr += 1
+    process_row(ctr, row)
+else:
+  print 'Running update with %d workers.' % num_workers
+  run_workers(rows, num_workers)
+update_state.close()
+if doi_updates is not None:
+  doi_updates.Close()
+if mapping_store is not None:
+  mapping_store.close()
+if doi_update_tsv and os.path.isfile(doi_update_tsv):
+  print 'Consider running `python merge_doi_maps.py %s %s`' % (
+      doi_tsv, doi_update_tsv)